@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmark.py
+
+Timing and validation checks for the matching code in linkers.py.  Uses the
+MID, Linker and Clusters sections of a linkers.py configuration file.  With
+--pipeline, runs the end-to-end suite on reads from simulate.py instead - 
+per-stage time and accuracy, and reads/sec across input sizes and worker 
+counts.  With --schema, compares the inline and split database schemas.
+
+Copyright (c) 2010 Brant Faircloth. All rights reserved.
+"""
+
+import os, re, sys, time, random, tempfile, resource, optparse, ConfigParser, \
+multiprocessing, cPickle
+from Bio.SeqIO import QualityIO
+import linkers, simulate
+
+def mutate(tag, errors=1):
+    '''Introduce errors random substitutions/insertions/deletions into tag'''
+    for e in xrange(errors):
+        i = random.randrange(len(tag))
+        kind = random.choice(['sub', 'ins', 'del'])
+        if kind == 'sub':
+            tag = tag[:i] + random.choice('ACGTN'.replace(tag[i], '')) + \
+            tag[i+1:]
+        elif kind == 'ins':
+            tag = tag[:i] + random.choice('ACGT') + tag[i:]
+        else:
+            tag = tag[:i] + tag[i+1:]
+    return tag
+
+def randomSeq(length):
+    '''Random sequence of length bases'''
+    return ''.join([random.choice('ACGT') for i in xrange(length)])
+
+def tagReads(tags, n, min_len=150, max_len=400):
+    '''Build n reads carrying a (mostly) 1-error copy of one of tags near the
+    5' end.  Returns a list of (tag, read)'''
+    reads = []
+    for i in xrange(n):
+        tag = random.choice(tags)
+        if random.random() < 0.9:
+            t = mutate(tag)
+        else:
+            t = tag
+        reads.append((tag, randomSeq(random.randint(0, 5)) + t +
+            randomSeq(random.randint(min_len, max_len))))
+    return reads
+
+def taggedReads(index, n, min_len=150, max_len=400, error_rate=0.2):
+    '''Build n reads of MID + linker + insert + reverse complement linker 
+    for the clusters in index (a TagIndex), with 1-error tags at error_rate'''
+    pairs = [(mid, linker) for mid in index.tags for linker in index.tags[mid]]
+    reads = []
+    for i in xrange(n):
+        mid, linker = random.choice(pairs)
+        parts = [mid, linker, linkers.revComp(linker)]
+        for j in xrange(len(parts)):
+            if random.random() < error_rate:
+                parts[j] = mutate(parts[j])
+        reads.append(parts[0] + parts[1] + randomSeq(random.randint(min_len, 
+            max_len)) + parts[2])
+    return reads
+
+def legacyLeftLinker(s, tags, max_gap_char, gaps=False, fuzzy=False):
+    '''The per-read matching path from before TagIndex:  compile every tag 
+    pattern for every read'''
+    for tag in tags:
+        if gaps:
+            r = re.compile(('^%s') % (tag))
+        else:
+            r = re.compile(('^[acgtnACGTN]{0,%s}%s') % (max_gap_char, tag))
+        match = re.search(r, s)
+        if match:
+            return tag, 'regex', match.start(), match.end(), tag
+    if fuzzy:
+        match = linkers.fuzzyMatch(s, tags, 1)
+        if match:
+            start, stop = linkers.SWMatchPos(match[3], match[4], match[5])
+            return match[0], 'fuzzy', start, stop, match[3]
+    return None
+
+def legacyRightLinker(s, tags, max_gap_char, gaps=False, fuzzy=False):
+    '''The per-read matching path from before TagIndex:  rebuild the reverse
+    complements and compile every tag pattern for every read'''
+    revtags = linkers.revCompTags(tags)
+    for tag in revtags:
+        if gaps:
+            r = re.compile(('%s$') % (tag))
+        else:
+            r = re.compile(('%s[acgtnACGTN]{0,%s}$') % (tag, max_gap_char))
+        match = re.search(r, s)
+        if match:
+            return linkers.revComp(tag), 'regex', match.start(), match.end(), \
+            tag
+    if fuzzy:
+        match = linkers.fuzzyMatch(s, revtags, 1)
+        if match:
+            start, stop = linkers.SWMatchPos(match[3], match[4], match[5])
+            return linkers.revComp(match[0]), 'fuzzy', start, stop, match[3]
+    return None
+
+def benchTagIndex(index, n, fuzzy=False):
+    '''Time MID + both linker ends for n reads, per-read regex compilation 
+    vs. the TagIndex'''
+    reads = taggedReads(index, n)
+    start = time.time()
+    for s in reads:
+        mid = legacyLeftLinker(s, index.tags, 22, True, fuzzy)
+        if mid:
+            legacyLeftLinker(s[mid[3]:], index.tags[mid[0]], 22, fuzzy=fuzzy)
+            legacyRightLinker(s[mid[3]:], index.tags[mid[0]], 22, fuzzy=fuzzy)
+    legacy = time.time() - start
+    start = time.time()
+    for s in reads:
+        mid = linkers.leftLinker(s, index.mids, fuzzy=fuzzy)
+        if mid:
+            linkers.leftLinker(s[mid[3]:], index.linkers[mid[0]], fuzzy=fuzzy)
+            linkers.rightLinker(s[mid[3]:], index.linkers[mid[0]], fuzzy=fuzzy)
+    indexed = time.time() - start
+    print 'Tag matching, %s (%s reads)' % (['regex only', 'regex + fuzzy'][fuzzy], n)
+    print '    per-read compile:  %.3f sec (%.1f reads/sec)' % (legacy, 
+        n / legacy)
+    print '    TagIndex:          %.3f sec (%.1f reads/sec)' % (indexed, 
+        n / indexed)
+    return legacy, indexed
+
+def writeFastaQual(reads, prefix):
+    '''Write reads to prefix.fna/prefix.qual with random quality scores'''
+    fasta, qual = open(prefix + '.fna', 'w'), open(prefix + '.qual', 'w')
+    for i, seq in enumerate(reads):
+        scores = [random.choice([8, 20, 30, 35, 40]) for b in seq]
+        fasta.write('>read%s length=%s\n%s\n' % (i, len(seq), seq))
+        qual.write('>read%s length=%s\n%s\n' % (i, len(seq), 
+            ' '.join([str(q) for q in scores])))
+    fasta.close()
+    qual.close()
+    return prefix + '.fna', prefix + '.qual'
+
+def parseAndTrim(parser, fasta, qual, chunksize, results):
+    '''Child process for benchParser - parse and quality trim in chunks (as 
+    the workers do), reporting reads/sec and peak RSS'''
+    start, count = time.time(), 0
+    for chunk in linkers.chunks(parser(open(fasta, 'rU'), open(qual, 'rU')), 
+    chunksize):
+        linkers.qualTrimRecords(chunk)
+        count += len(chunk)
+    elapsed = time.time() - start
+    results.put((count / elapsed, 
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def benchParser(index, n, chunksize=1000):
+    '''Compare the Biopython FASTA + QUAL path against pairedFastaQual/Read
+    on n reads.  Each runs in its own process so peak RSS is comparable'''
+    directory = tempfile.mkdtemp()
+    fasta, qual = writeFastaQual(taggedReads(index, n), os.path.join(directory,
+        'bench'))
+    print 'FASTA + QUAL parsing and quality trimming (%s reads)' % n
+    for name, parser in [('Biopython', QualityIO.PairedFastaQualIterator), 
+    ('pairedFastaQual', linkers.pairedFastaQual)]:
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(target=parseAndTrim, args=(parser, fasta, 
+            qual, chunksize, results))
+        p.start()
+        rate, rss = results.get()
+        p.join()
+        print '    %-16s %.1f reads/sec, peak RSS = %.1f MB' % (name + ':', rate,
+            rss / 1024.)
+    for f in (fasta, qual):
+        os.remove(f)
+    os.rmdir(directory)
+
+def benchEncoding(index, n):
+    '''Compare pickled SeqRecords against encodeRecord/decodeRecord for the 
+    record BLOB - size and encode/decode speed - on n quality trimmed reads'''
+    directory = tempfile.mkdtemp()
+    fasta, qual = writeFastaQual(taggedReads(index, n), os.path.join(directory,
+        'bench'))
+    reads = [t for t, count in linkers.qualTrimRecords(list(
+        linkers.pairedFastaQual(open(fasta, 'rU'), open(qual, 'rU'))))]
+    records = [r.toSeqRecord() for r in reads]
+    for f in (fasta, qual):
+        os.remove(f)
+    os.rmdir(directory)
+    print 'Record BLOB encoding (%s reads)' % n
+    for name, items, encode, decode in [
+    ('cPickle', records, lambda r: cPickle.dumps(r, 1), cPickle.loads),
+    ('encodeRecord', reads, linkers.encodeRecord, linkers.decodeRecord)]:
+        start = time.time()
+        blobs = [encode(r) for r in items]
+        middle = time.time()
+        for b in blobs:
+            decode(b)
+        end = time.time()
+        size = sum([len(b) for b in blobs])
+        print '    %-14s %.1f bytes/read, encode %.1f reads/sec, decode %.1f reads/sec' % \
+        (name + ':', float(size) / n, n / (middle - start), n / (end - middle))
+
+def legacyConcatCheck(s, all_tags, all_tags_regex):
+    '''The concatemer check from before ConcatScanner:  every tag regex, then
+    smithWaterman over every tag'''
+    for tag in all_tags_regex:
+        if re.search(tag, s):
+            return tag.pattern, 'regex-concat', tag.pattern
+    match = linkers.smithWaterman(s, all_tags, 1)
+    if match:
+        return match[0], 'fuzzy-concat', match[3]
+    return None, None, None
+
+def benchConcat(index, n, rate=0.2):
+    '''Compare concatCheck (ConcatScanner) against the previous regex + 
+    smithWaterman check on n inserts, rate of which carry a linker'''
+    inserts = []
+    for i in xrange(n):
+        s = randomSeq(random.randint(100, 300))
+        if random.random() < rate:
+            pos = random.randint(0, len(s))
+            s = s[:pos] + mutate(random.choice(index.all_tags), 
+                random.choice([0, 1])) + s[pos:]
+        inserts.append(s)
+    agree, legacy, scanned = 0, 0., 0.
+    for s in inserts:
+        start = time.time()
+        old = legacyConcatCheck(s, index.all_tags, index.all_tags_regex)
+        middle = time.time()
+        new = linkers.concatCheck(linkers.Read('insert', s, None), 
+            index.concat, fuzzy=True)
+        legacy += middle - start
+        scanned += time.time() - middle
+        if old[:2] == new[:2]:
+            agree += 1
+    print 'Concatemer check (%s inserts)' % n
+    print '    identical results:  %s (%.2f%%)' % (agree, 100. * agree / n)
+    print '    regex + smithWaterman:  %.3f sec (%.1f reads/sec)' % (legacy, 
+        n / legacy)
+    print '    ConcatScanner:          %.3f sec (%.1f reads/sec)' % (scanned, 
+        n / scanned)
+
+def benchStages(index, records, truth, qual=10):
+    '''Run records one stage at a time - qualTrimming, midTrim, linkerTrim 
+    and concatCheck, as linkerWorker does - timing each stage and scoring it
+    against truth (from simulate.readTruth)'''
+    times = dict.fromkeys(['qual', 'mid', 'linker', 'concat'], 0.)
+    correct = dict.fromkeys(['qual', 'mid', 'linker'], 0)
+    concat = dict.fromkeys(['tp', 'fp', 'fn', 'n'], 0)
+    recoverable, recovered = 0, 0
+    for record in records:
+        t = truth[record.id]
+        start = time.time()
+        trimmed = linkers.qualTrimming(record, qual)
+        times['qual'] += time.time() - start
+        if len(record.seq) - len(trimmed.seq) == t['trim_left']:
+            correct['qual'] += 1
+        start = time.time()
+        mid = linkers.midTrim(trimmed, index.mids, fuzzy=True)
+        times['mid'] += time.time() - start
+        cluster, l_trimmed = None, None
+        if mid:
+            start = time.time()
+            linker = linkers.linkerTrim(mid[1], index.linkers[mid[0]], 
+                fuzzy=True)
+            times['linker'] += time.time() - start
+            if linker:
+                cluster, l_trimmed = linker[3], linker[1]
+        if index.reverse_mid[mid and mid[0]] == t['mid']:
+            correct['mid'] += 1
+        if cluster == t['cluster']:
+            correct['linker'] += 1
+        if t['mid_errors'] <= 1 and t['linker_errors'] <= 1:
+            recoverable += 1
+            recovered += cluster == t['cluster']
+        if l_trimmed and len(l_trimmed.seq) > 0:
+            start = time.time()
+            found = linkers.concatCheck(l_trimmed, index.concat, 
+                fuzzy=True)[0] is not None
+            times['concat'] += time.time() - start
+            concat['n'] += 1
+            if found and t['concat']:
+                concat['tp'] += 1
+            elif found:
+                concat['fp'] += 1
+            elif t['concat']:
+                concat['fn'] += 1
+    n = len(records)
+    rate = lambda stage: n / max(times[stage], 1e-9)
+    print 'Per-stage timing and accuracy (%s simulated reads)' % n
+    print '    qualTrimming:  %.3f sec (%.1f reads/sec), left trim correct %.2f%%' % \
+    (times['qual'], rate('qual'), 100. * correct['qual'] / n)
+    print '    midTrim:       %.3f sec (%.1f reads/sec), MID correct %.2f%%' % \
+    (times['mid'], rate('mid'), 100. * correct['mid'] / n)
+    print '    linkerTrim:    %.3f sec (%.1f reads/sec), cluster correct %.2f%% (%.2f%% of reads with <= 1 error per tag)' % \
+    (times['linker'], rate('linker'), 100. * correct['linker'] / n, 
+    100. * recovered / max(recoverable, 1))
+    print '    concatCheck:   %.3f sec (%s reads), %s found, %s false positives, %s missed' % \
+    (times['concat'], concat['n'], concat['tp'], concat['fp'], concat['fn'])
+    return times, correct, concat
+
+def clusterAccuracy(rows, truth):
+    '''Fraction of linkerWorker rows assigned to their true cluster'''
+    right = sum([row[9] == truth[row[0]]['cluster'] for row in rows])
+    return float(right) / max(len(rows), 1)
+
+def fuzzyScans(n):
+    '''Print, per read, the fuzzyMatch tag scans that were run and the ones 
+    the tagPieces prefilter avoided, from (and resetting) linkers.STATS'''
+    counts = linkers.STATS.snapshot()[0]
+    scans = counts.get('fuzzy scans', 0)
+    pruned = counts.get('fuzzy scans pruned', 0)
+    print '        fuzzy scans per read:  %.3f run, %.3f avoided (%.1f%%)' % \
+    (float(scans) / n, float(pruned) / n, 100. * pruned / max(scans + pruned,
+    1))
+
+def benchPipeline(conf, index, sizes, workers, sharding=False):
+    '''End-to-end reads/sec (parsing through the concatemer check, without
+    the writer) and cluster accuracy on simulated reads, for each input size
+    and worker count.  One worker runs in-process, as main does without 
+    multiprocessing'''
+    qual = conf.getint('Qual', 'MIN_SCORE')
+    chunksize = 1000
+    directory = tempfile.mkdtemp()
+    simulator = simulate.ReadSimulator(index, qual)
+    for n in sizes:
+        fasta, qual_file, truth_file = simulate.writeReads(simulator, n, 
+            os.path.join(directory, 'sim'))
+        truth = simulate.readTruth(truth_file)
+        benchStages(index, list(linkers.pairedFastaQual(open(fasta, 'rU'), 
+            open(qual_file, 'rU'))), truth, qual)
+        print 'End-to-end (%s simulated reads)' % n
+        for w in workers:
+            linkers.STATS.snapshot()
+            start = time.time()
+            if w <= 1:
+                rows = []
+                for chunk in linkers.chunks(linkers.pairedFastaQual(open(fasta, 
+                'rU'), open(qual_file, 'rU')), chunksize):
+                    rows.extend(linkers.processChunk(chunk, qual, index))
+            elif sharding:
+                rows = [row for rows in linkers.shardPool(fasta, qual_file, 
+                    conf, w, 4 * w, chunksize, index) for row in rows]
+            else:
+                rows = [row for rows in linkers.pool(linkers.pairedFastaQual(
+                    open(fasta, 'rU'), open(qual_file, 'rU')), conf, w, 
+                    chunksize, index) for row in rows]
+            elapsed = time.time() - start
+            print '    %2s worker(s):  %.3f sec (%.1f reads/sec), cluster correct %.2f%%' % \
+            (w, elapsed, n / elapsed, 100. * clusterAccuracy(rows, truth))
+            fuzzyScans(n)
+        for f in (fasta, qual_file, truth_file):
+            os.remove(f)
+    os.rmdir(directory)
+
+def benchSchema(conf, index, n, repeat=10):
+    '''Load n simulated reads with the inline schema (indexes maintained 
+    during the load) and the split schema (bulk load, indexes built 
+    afterwards), reporting load time, index build time and cluster query 
+    time.  Uses the configured database - or a temporary SQLite database, if
+    the output sink is files'''
+    directory = tempfile.mkdtemp()
+    if linkers.outputSink(conf) == 'files':
+        conf.set('Output', 'SINK', 'sqlite')
+        conf.set('Output', 'PATH', os.path.join(directory, 'bench.sqlite'))
+    sink = linkers.outputSink(conf)
+    qual = conf.getint('Qual', 'MIN_SCORE')
+    fasta, qual_file, truth_file = simulate.writeReads(simulate.ReadSimulator(
+        index, qual), n, os.path.join(directory, 'sim'))
+    rows = []
+    for chunk in linkers.chunks(linkers.pairedFastaQual(open(fasta, 'rU'), 
+    open(qual_file, 'rU')), 1000):
+        rows.extend(linkers.processChunk(chunk, qual, index))
+    clusters = sorted(set([row[9] for row in rows if row[9]]))
+    query = '''SELECT name, seq_trimmed FROM sequence WHERE cluster = %s'''
+    if sink == 'sqlite':
+        query = query.replace('%s', '?')
+    print 'Schema and load (%s simulated reads, %s)' % (n, sink)
+    for schema, bulk in (('inline', 'False'), ('split', 'True')):
+        conf.set('Database', 'SCHEMA', schema)
+        conf.set('Database', 'BULK_LOAD', bulk)
+        linkers.prepareOutput(conf, linkers.LINKER_INSERT)
+        start = time.time()
+        writer = linkers.openWriter(conf, linkers.LINKER_INSERT)
+        for row in rows:
+            writer.write(row)
+        writer.close()
+        load = time.time() - start
+        index_time = linkers.finishOutput(conf, linkers.LINKER_INSERT) or 0.
+        conn = linkers.outputConnection(conf)
+        cur = conn.cursor()
+        start = time.time()
+        for i in xrange(repeat):
+            for cluster in clusters:
+                cur.execute(query, (cluster,))
+                cur.fetchall()
+        queries = (time.time() - start) / (repeat * len(clusters))
+        cur.close()
+        conn.close()
+        print '    %-7s load %.3f sec (%.1f rows/sec), index build %.3f sec, cluster query %.2f msec' % \
+        (schema + ':', load, n / load, index_time, 1000 * queries)
+    for f in os.listdir(directory):
+        os.remove(os.path.join(directory, f))
+    os.rmdir(directory)
+
+def matchKey(match):
+    '''Reduce a smithWaterman/fuzzyMatch result to what the callers use - the
+    tag, the trim positions and the matched span'''
+    if match:
+        return match[0], linkers.SWMatchPos(match[3], match[4], match[5]), \
+        match[3]
+    return None
+
+def validateFuzzy(tags, n):
+    '''Compare fuzzyMatch against smithWaterman (pairwise2) on n reads'''
+    reads = tagReads(tags, n)
+    agree, differ, sw_time, fuzzy_time = 0, [], 0., 0.
+    for tag, seq in reads:
+        start = time.time()
+        sw = linkers.smithWaterman(seq, tags, 1)
+        middle = time.time()
+        fuzzy = linkers.fuzzyMatch(seq, tags, 1)
+        sw_time += middle - start
+        fuzzy_time += time.time() - middle
+        if matchKey(sw) == matchKey(fuzzy):
+            agree += 1
+        else:
+            differ.append((seq, matchKey(sw), matchKey(fuzzy)))
+    print 'fuzzyMatch vs. smithWaterman (%s reads)' % n
+    print '    identical results:  %s (%.2f%%)' % (agree, 100. * agree / n)
+    print '    smithWaterman:  %.3f sec (%.1f reads/sec)' % (sw_time,
+        n / sw_time)
+    print '    fuzzyMatch:     %.3f sec (%.1f reads/sec)' % (fuzzy_time,
+        n / fuzzy_time)
+    for seq, sw, fuzzy in differ[:10]:
+        print '    %s\n        smithWaterman = %s\n        fuzzyMatch    = %s' \
+        % (seq[:40], sw, fuzzy)
+    return agree, differ
+
+def interface():
+    '''Command-line interface'''
+    usage = "usage: %prog [options]"
+
+    p = optparse.OptionParser(usage)
+
+    p.add_option('--configuration', '-c', dest = 'conf', action='store', \
+type='string', default = None, help='The path to the configuration file.', \
+metavar='FILE')
+    p.add_option('--reads', '-n', dest = 'reads', action='store', \
+type='int', default = 1000, help='The number of reads to simulate.')
+    p.add_option('--seed', dest = 'seed', action='store', type='int', \
+default = None, help='Random seed.')
+    p.add_option('--pipeline', dest = 'pipeline', action='store_true', \
+default=False, help='Run the end-to-end suite on simulated reads.')
+    p.add_option('--sizes', dest = 'sizes', action='store', type='string', \
+default = '1000,10000', help='Comma-separated input sizes for --pipeline.')
+    p.add_option('--workers', dest = 'workers', action='store', \
+type='string', default = '1,2,4', help='Comma-separated worker counts for \
+--pipeline.')
+    p.add_option('--sharding', dest = 'sharding', action='store_true', \
+default=False, help='Shard the input (rather than parse it in the parent) \
+with --pipeline.')
+    p.add_option('--schema', dest = 'schema', action='store_true', \
+default=False, help='Compare the inline and split (bulk load) schemas on the \
+configured database.')
+
+    (options,arg) = p.parse_args()
+    if not options.conf or not os.path.isfile(options.conf):
+        print "You must provide a valid path to the configuration file."
+        p.print_help()
+        sys.exit(2)
+    return options, arg
+
+def main():
+    options, arg = interface()
+    random.seed(options.seed)
+    conf = ConfigParser.ConfigParser()
+    conf.read(options.conf)
+    index = linkers.tagIndex(conf)
+    if options.pipeline:
+        benchPipeline(conf, index, [int(n) for n in options.sizes.split(',')],
+            [int(w) for w in options.workers.split(',')], options.sharding)
+        return
+    if options.schema:
+        benchSchema(conf, index, options.reads)
+        return
+    validateFuzzy(index.tags.keys() + list(set(index.all_tags)), options.reads)
+    benchTagIndex(index, options.reads)
+    benchTagIndex(index, options.reads, fuzzy=True)
+    benchParser(index, options.reads * 10)
+    benchEncoding(index, options.reads * 10)
+    benchConcat(index, options.reads)
+
+if __name__ == '__main__':
+    main()
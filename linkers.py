@@ -7,10 +7,11 @@ Created by Brant Faircloth on 2009-08-14.
 Copyright (c) 2009 Brant Faircloth. All rights reserved.
 """
 
-import os, sys, re, pdb, time, numpy, string, MySQLdb, ConfigParser, multiprocessing, cPickle, optparse, progress
+import os, sys, re, pdb, time, numpy, string, array, struct, ConfigParser, multiprocessing, cPickle, optparse, Queue, traceback, sqlite3, mmap, json, cProfile, \
+pstats, zlib, bz2, threading, socket, cStringIO, multiprocessing.managers
 from Bio import Seq
+from Bio.SeqRecord import SeqRecord
 from Bio import pairwise2
-from Bio.SeqIO import QualityIO
 from Bio.Alphabet import SingleLetterAlphabet
 
 def revComp(seq):
@@ -51,6 +52,403 @@ def allPossibleTags(mids, linkers, clust):
         rat.append(re.compile('%s' % revComp(linkers[l])))
     return at, rat
             
+class Read(object):
+    '''Compact sequence read:  the id, description, sequence (a str) and 
+    quality scores (an array('B')).  Slicing a Read gives a new Read that 
+    shares its parent's sequence and qualities and only moves the start/stop
+    offsets, so trimming never copies the data'''
+    __slots__ = ('id', 'description', '_seq', '_qual', 'start', 'stop')
+    
+    def __init__(self, id, seq, qual, description='', start=0, stop=None):
+        self.id = id
+        self.description = description
+        self._seq = seq
+        self._qual = qual
+        self.start = start
+        if stop is None:
+            stop = len(seq)
+        self.stop = stop
+    
+    def __len__(self):
+        return self.stop - self.start
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('Read slices must be contiguous')
+            return Read(self.id, self._seq, self._qual, self.description, 
+                self.start + start, self.start + max(start, stop))
+        return self.seq[index]
+    
+    def __getstate__(self):
+        # only ship/pickle the part of the read we are looking at
+        return self.id, self.description, self.seq, self.qual
+    
+    def __setstate__(self, state):
+        self.id, self.description, self._seq, self._qual = state
+        self.start, self.stop = 0, len(self._seq)
+    
+    def __repr__(self):
+        return 'Read(%r, %r)' % (self.id, self.seq)
+    
+    @property
+    def seq(self):
+        return self._seq[self.start:self.stop]
+    
+    @property
+    def qual(self):
+        return self._qual[self.start:self.stop]
+    
+    def toSeqRecord(self):
+        '''Convert to a Biopython SeqRecord (with phred_quality)'''
+        record = SeqRecord(Seq.Seq(self.seq, SingleLetterAlphabet()), 
+            id=self.id, name=self.id, description=self.description)
+        record.letter_annotations['phred_quality'] = self.qual.tolist()
+        return record
+
+def phredQuality(record):
+    '''Return the quality scores of a Read or SeqRecord'''
+    if isinstance(record, Read):
+        return record.qual
+    return record.letter_annotations["phred_quality"]
+
+# compact record encoding (see encodeRecord)
+RECORD_MAGIC = 'TGR'
+RECORD_VERSION = 1
+RECORD_HEADER = struct.Struct('>3sBBIIIHH')
+# 2-bit (ACGT) and 4-bit (IUPAC, N and gap) alphabets.  Anything else is 
+# stored 8-bit, as is
+ALPHABETS = {2:'ACGT', 4:'ACGTNRYSWKMBDHV-'}
+
+def _codes(alphabet):
+    table = numpy.zeros(256, dtype=numpy.uint8) + 255
+    for i, base in enumerate(alphabet):
+        table[ord(base)] = i
+    return table
+
+CODES = dict([(bits, _codes(ALPHABETS[bits])) for bits in ALPHABETS])
+
+def packSequence(seq):
+    '''Pack seq into 2 (or, with N or ambiguity codes, 4) bits per base.  
+    Returns the number of bits per base and the packed string'''
+    raw = numpy.frombuffer(seq, dtype=numpy.uint8)
+    for bits in (2, 4):
+        codes = CODES[bits][raw]
+        if not (codes == 255).any():
+            break
+    else:
+        return 8, seq
+    per = 8 // bits
+    codes = numpy.concatenate((codes, numpy.zeros(-len(codes) % per, 
+        dtype=numpy.uint8))).reshape(-1, per)
+    packed = numpy.zeros(len(codes), dtype=numpy.uint8)
+    for k in xrange(per):
+        packed |= codes[:, k] << (bits * k)
+    return bits, packed.tostring()
+
+def unpackSequence(packed, bits, length):
+    '''Reverse packSequence'''
+    if bits == 8:
+        return packed[:length]
+    per = 8 // bits
+    codes = (numpy.frombuffer(packed, dtype=numpy.uint8)[:, None] >> 
+        (bits * numpy.arange(per, dtype=numpy.uint8))) & ((1 << bits) - 1)
+    alphabet = numpy.frombuffer(ALPHABETS[bits], dtype=numpy.uint8)
+    return alphabet[codes.ravel()[:length]].tostring()
+
+def encodeRecord(record):
+    '''Encode a Read (or SeqRecord) for the record BLOB column.  The format is
+    versioned:  a header (magic, version, bits per base, length, trim start 
+    and stop, id and description lengths), the id and description, the packed
+    untrimmed sequence and its uint8 qualities.  Storing the untrimmed read 
+    plus the trim offsets means decodeRecord can give back either one'''
+    if isinstance(record, Read):
+        seq, qual = record._seq, record._qual
+        start, stop = record.start, record.stop
+    else:
+        seq = str(record.seq)
+        qual = array.array('B', record.letter_annotations["phred_quality"])
+        start, stop = 0, len(seq)
+    bits, packed = packSequence(seq)
+    return RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, bits, len(seq), 
+        start, stop, len(record.id), len(record.description)) + record.id + \
+        record.description + packed + qual.tostring()
+
+def decodeRecord(blob):
+    '''Rebuild a Read from a record BLOB - either our encoding (see 
+    encodeRecord) or a pickled SeqRecord from an older run'''
+    if not blob.startswith(RECORD_MAGIC):
+        return readFromSeqRecord(cPickle.loads(blob))
+    magic, version, bits, length, start, stop, id_len, desc_len = \
+    RECORD_HEADER.unpack_from(blob)
+    if version != RECORD_VERSION:
+        raise ValueError('Unknown record encoding version %s' % version)
+    offset = RECORD_HEADER.size
+    id = blob[offset:offset + id_len]
+    offset += id_len
+    description = blob[offset:offset + desc_len]
+    offset += desc_len
+    packed_len = (length * bits + 7) // 8
+    seq = unpackSequence(blob[offset:offset + packed_len], bits, length)
+    qual = array.array('B', blob[offset + packed_len:offset + packed_len + 
+        length])
+    return Read(id, seq, qual, description, start, stop)
+
+def readFromSeqRecord(record):
+    '''Convert a SeqRecord (with phred_quality) to a Read'''
+    return Read(record.id, str(record.seq), array.array('B', 
+        record.letter_annotations["phred_quality"]), record.description)
+
+def migrateRecords(conf, batch_size=1000):
+    '''Re-encode any pickled SeqRecords in the record column of an existing
+    sequence table (or sequence_record, for the split schema) with 
+    encodeRecord'''
+    import MySQLdb
+    conn = MySQLdb.connect(user=conf.get('Database','USER'), 
+        passwd=conf.get('Database','PASSWORD'), 
+        db=conf.get('Database','DATABASE'))
+    cur = conn.cursor()
+    table = schemaSettings(conf)[0] and 'sequence_record' or 'sequence'
+    last, migrated = 0, 0
+    while True:
+        cur.execute('''SELECT id, record FROM %s WHERE id > %%s ORDER BY 
+            id LIMIT %%s''' % table, (last, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        updates = [(encodeRecord(decodeRecord(record)), id) for id, record 
+            in rows if record and not record.startswith(RECORD_MAGIC)]
+        if updates:
+            cur.executemany('''UPDATE %s SET record = %%s WHERE id = %%s''' % 
+                table, updates)
+            conn.commit()
+            migrated += len(updates)
+    cur.close()
+    conn.close()
+    return migrated
+
+def fastaEntries(handle, sep=''):
+    '''Stream (title, body) pairs out of a FASTA-formatted handle, joining the
+    body lines with sep'''
+    title, lines = None, []
+    for line in handle:
+        if line.startswith('>'):
+            if title is not None:
+                yield title, sep.join(lines)
+            title, lines = line[1:].rstrip(), []
+        elif title is not None:
+            line = line.strip()
+            if line:
+                lines.append(line)
+    if title is not None:
+        yield title, sep.join(lines)
+
+def pairedFastaQual(fasta, qual):
+    '''Stream Reads from a FASTA + QUAL file pair (open handles).  Replaces 
+    QualityIO.PairedFastaQualIterator, but without building a SeqRecord for
+    every read'''
+    seqs, quals = fastaEntries(fasta), fastaEntries(qual, ' ')
+    for title, seq in seqs:
+        try:
+            qual_title, scores = quals.next()
+        except StopIteration:
+            raise ValueError('%s has no entry in the QUAL file' % title)
+        name = title.split(None, 1)[0]
+        if qual_title.split(None, 1)[0] != name:
+            raise ValueError('FASTA (%s) and QUAL (%s) records are out of sync'\
+            % (name, qual_title))
+        scores = array.array('B', numpy.fromstring(scores, dtype=numpy.uint8, 
+            sep=' ').tostring())
+        if len(scores) != len(seq):
+            raise ValueError('%s has %s bases but %s quality scores' % (name, 
+                len(seq), len(scores)))
+        yield Read(name, seq, scores, title)
+    for qual_title, scores in quals:
+        raise ValueError('%s has no entry in the FASTA file' % qual_title)
+
+COMPRESSED = {'.gz':lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), 
+    '.bz2':bz2.BZ2Decompressor}
+
+class DecompressingReader(object):
+    '''Iterate over the lines of a gzip or bzip2 compressed file.  The file is
+    read and inflated in blocks by a background thread (zlib and bz2 release 
+    the GIL while they work), so decompression overlaps with parsing and 
+    trimming rather than needing a decompressed copy on disk.  At most depth
+    blocks are buffered'''
+    def __init__(self, path, blocksize=1048576, depth=8):
+        self.path = path
+        self.decompressor = COMPRESSED[os.path.splitext(path)[1]]
+        self.blocks = Queue.Queue(depth)
+        self.thread = threading.Thread(target=self._inflate, args=(blocksize,))
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def _inflate(self, blocksize):
+        try:
+            handle = open(self.path, 'rb')
+            d = self.decompressor()
+            while True:
+                block = handle.read(blocksize)
+                if not block:
+                    break
+                # files may hold several concatenated gzip members/bzip2 
+                # streams - start over on whatever follows the end of one
+                while block:
+                    try:
+                        out = d.decompress(block)
+                    except EOFError:
+                        d = self.decompressor()
+                        continue
+                    if out:
+                        self.blocks.put(out)
+                    block = d.unused_data
+                    if block:
+                        d = self.decompressor()
+            handle.close()
+            self.blocks.put(None)
+        except Exception, e:
+            self.blocks.put(e)
+    
+    def __iter__(self):
+        rest = ''
+        while True:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise IOError('Could not decompress %s:  %s' % (self.path, 
+                    block))
+            if block is None:
+                break
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if rest:
+            yield rest
+
+def openInput(path):
+    '''Open an input file for reading lines - .gz and .bz2 files are 
+    decompressed in the background (see DecompressingReader)'''
+    if os.path.splitext(path)[1] in COMPRESSED:
+        return DecompressingReader(path)
+    return open(path, 'rU')
+
+def fastqRecords(handle, offset=33):
+    '''Stream Reads from a (4-line) FASTQ file, with quality scores encoded 
+    as chr(score + offset)'''
+    lines = iter(handle)
+    for title in lines:
+        if not title.strip():
+            continue
+        try:
+            seq, plus, scores = lines.next(), lines.next(), lines.next()
+        except StopIteration:
+            raise ValueError('Truncated FASTQ record %s' % title.strip())
+        if not title.startswith('@') or not plus.startswith('+'):
+            raise ValueError('%s is not a FASTQ record' % title.strip())
+        title, seq, scores = title[1:].rstrip(), seq.rstrip(), scores.rstrip()
+        name = title.split(None, 1)[0]
+        if len(scores) != len(seq):
+            raise ValueError('%s has %s bases but %s quality scores' % (name, 
+                len(seq), len(scores)))
+        scores = array.array('B', (numpy.frombuffer(scores, dtype=numpy.uint8)
+            - offset).tostring())
+        yield Read(name, seq, scores, title)
+
+def inputSettings(conf):
+    '''The input files from [Input]:  (FASTQ, None) when FASTQ is given, 
+    otherwise (SEQUENCE, QUAL)'''
+    if conf.has_option('Input', 'FASTQ'):
+        return conf.get('Input', 'FASTQ'), None
+    return conf.get('Input', 'SEQUENCE'), conf.get('Input', 'QUAL')
+
+def inputRecords(conf):
+    '''Stream Reads from the configured input - a FASTQ file or a FASTA + QUAL
+    pair, either of which may be gzip or bzip2 compressed'''
+    sequence, qual = inputSettings(conf)
+    if qual is None:
+        offset = 33
+        if conf.has_option('Input', 'PHRED_OFFSET'):
+            offset = conf.getint('Input', 'PHRED_OFFSET')
+        return fastqRecords(openInput(sequence), offset)
+    return pairedFastaQual(openInput(sequence), openInput(qual))
+
+def _mmap(path):
+    '''Read-only memory map of path (None if the file is empty)'''
+    handle = open(path, 'rb')
+    try:
+        if not os.fstat(handle.fileno()).st_size:
+            return None
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        handle.close()
+
+def _findTitle(m, name, start):
+    '''Offset of the '>name' title line at or after start in m, or -1'''
+    target = '>' + name
+    pos = start
+    while True:
+        pos = m.find(target, pos)
+        if pos == -1:
+            return -1
+        end = pos + len(target)
+        if (pos == 0 or m[pos - 1] == '\n') and (end == len(m) or 
+        m[end] in ' \t\r\n'):
+            return pos
+        pos = end
+
+def shardRanges(fasta, qual, n):
+    '''Split a FASTA + QUAL file pair (paths) into (at most) n shards of 
+    roughly equal size, returned as (fasta start, fasta stop, qual start, 
+    qual stop) byte ranges.  Every range starts on a record boundary, and 
+    the FASTA and QUAL ranges of a shard hold the same reads, in the same 
+    order'''
+    seqs, quals = _mmap(fasta), _mmap(qual)
+    if seqs is None:
+        return []
+    try:
+        size = len(seqs)
+        bounds = [(0, 0)]
+        for i in xrange(1, n):
+            pos = seqs.find('\n>', max(i * size // n - 1, bounds[-1][0]))
+            if pos == -1:
+                break
+            pos += 1
+            name = seqs[pos + 1:seqs.find('\n', pos)].split(None, 1)[0]
+            qual_pos = -1
+            if quals is not None:
+                qual_pos = _findTitle(quals, name, bounds[-1][1])
+            if qual_pos == -1:
+                raise ValueError('%s has no entry in the QUAL file (or the '\
+                    'files are out of sync)' % name)
+            bounds.append((pos, qual_pos))
+        bounds.append((size, len(quals) if quals is not None else 0))
+        return [(bounds[i][0], bounds[i + 1][0], bounds[i][1], 
+            bounds[i + 1][1]) for i in xrange(len(bounds) - 1)]
+    finally:
+        seqs.close()
+        if quals is not None:
+            quals.close()
+
+def _mmapLines(m, start, stop):
+    '''Lines of m between byte offsets start and stop'''
+    m.seek(start)
+    while m.tell() < stop:
+        yield m.readline()
+
+def shardRecords(fasta, qual, shard):
+    '''Stream the Reads in one shard (from shardRanges) of a FASTA + QUAL 
+    file pair'''
+    seqs, quals = _mmap(fasta), _mmap(qual)
+    try:
+        for record in pairedFastaQual(_mmapLines(seqs, *shard[:2]), 
+        _mmapLines(quals, *shard[2:])):
+            yield record
+    finally:
+        seqs.close()
+        quals.close()
+
 def trim(record, left=None, right=None):
     '''Trim a given sequence given left and right offsets'''
     if left and right:
@@ -113,11 +511,377 @@ def smithWaterman(seq, tags, allowed_errors):
     else:
         return None
 
+def myersScan(seq, tag, allowed_errors):
+    '''Bit-parallel (Myers 1999) scan of seq for tag.  Returns a list of 
+    (errors, end) for every position in seq where an occurrence of tag ends 
+    with <= allowed_errors edits'''
+    m = len(tag)
+    mask, high = (1 << m) - 1, 1 << (m - 1)
+    peq = {}
+    for i, base in enumerate(tag):
+        peq[base] = peq.get(base, 0) | (1 << i)
+    pv, mv, score = mask, 0, m
+    hits = []
+    for j, base in enumerate(seq):
+        eq = peq.get(base, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        # nothing shifts in at the top row - the match can start anywhere
+        ph, mh = (ph << 1) & mask, (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        if score <= allowed_errors:
+            hits.append((score, j + 1))
+    return hits
+
+def alignEnd(seq, tag, end, allowed_errors):
+    '''Local alignment (same scoring as smithWaterman:  5 match, -4 mismatch,
+    -9 gap open, -0.5 gap extend) of tag against the short stretch of seq 
+    around an approximate match ending at end.  Returns the score, the start 
+    of the alignment in seq and the aligned (gapped) seq and tag spans'''
+    offset = max(0, end - len(tag) - allowed_errors - 1)
+    window = seq[offset:end + 1]
+    n, m = len(window), len(tag)
+    # H = best local score, E = gap in the tag, F = gap in the sequence
+    H = [[0.] * (n + 1) for i in xrange(m + 1)]
+    E = [[-1e9] * (n + 1) for i in xrange(m + 1)]
+    F = [[-1e9] * (n + 1) for i in xrange(m + 1)]
+    best, bi, bj = 0., 0, 0
+    for i in xrange(1, m + 1):
+        for j in xrange(1, n + 1):
+            E[i][j] = max(H[i][j-1] - 9., E[i][j-1] - 0.5)
+            F[i][j] = max(H[i-1][j] - 9., F[i-1][j] - 0.5)
+            if tag[i-1] == window[j-1]:
+                d = H[i-1][j-1] + 5.
+            else:
+                d = H[i-1][j-1] - 4.
+            H[i][j] = max(0., d, E[i][j], F[i][j])
+            if H[i][j] > best:
+                best, bi, bj = H[i][j], i, j
+    i, j, state, cols = bi, bj, 'H', []
+    while i > 0 and j > 0:
+        if state == 'H':
+            if H[i][j] == 0:
+                break
+            if H[i][j] == E[i][j]:
+                state = 'E'
+            elif H[i][j] == F[i][j]:
+                state = 'F'
+            else:
+                cols.append((window[j-1], tag[i-1]))
+                i, j = i - 1, j - 1
+        elif state == 'E':
+            cols.append((window[j-1], '-'))
+            if E[i][j] != E[i][j-1] - 0.5:
+                state = 'H'
+            j -= 1
+        else:
+            cols.append(('-', tag[i-1]))
+            if F[i][j] != F[i-1][j] - 0.5:
+                state = 'H'
+            i -= 1
+    cols.reverse()
+    return best, offset + j, ''.join([c[0] for c in cols]), \
+        ''.join([c[1] for c in cols])
+
+# tag pieces for the fuzzyMatch prefilter, by (tag, allowed_errors)
+PIECES = {}
+
+def tagPieces(tag, allowed_errors):
+    '''Split tag into allowed_errors + 1 (near) equal, non-overlapping 
+    q-grams.  An edit only touches one of them, so any occurrence of tag with
+    <= allowed_errors edits holds at least one of them exactly'''
+    pieces = PIECES.get((tag, allowed_errors))
+    if pieces is None:
+        n = allowed_errors + 1
+        bounds = [len(tag) * i // n for i in xrange(n + 1)]
+        pieces = PIECES[(tag, allowed_errors)] = [tag[bounds[i]:bounds[i + 1]]
+            for i in xrange(n)]
+    return pieces
+
+def fuzzyMatch(seq, tags, allowed_errors, rank=None):
+    '''Bounded-error replacement for smithWaterman.  Each tag is located with 
+    a bit-parallel scan, and only the ends within allowed_errors are aligned
+    (so most tags/reads never get past the scan).  Tags with none of their 
+    tagPieces in seq are not scanned at all.  The best hit has the most 
+    matches, then the fewest errors, then the lowest rank (a dict of tag -> 
+    fixed position, by default the order of tags), so the order tags are 
+    tried in only decides how soon we can stop:  at a perfect match no later
+    tag could beat or tie.  Returns the same tuple as smithWaterman - tag, 
+    matches, seq_match, seq_match_span, start, end - or None'''
+    # tags may be any iterable of tags (a dict, as for smithWaterman)
+    tags = list(tags)
+    if rank is None:
+        rank = dict([(tag, i) for i, tag in enumerate(tags)])
+    high_score = {'tag':None, 'matches':None, 'errors':allowed_errors}
+    best_key = None
+    longest = max([len(tag) for tag in tags] or [0])
+    scanned, pruned = 0, 0
+    for i, tag in enumerate(tags):
+        for piece in tagPieces(tag, allowed_errors):
+            if piece in seq:
+                break
+        else:
+            pruned += 1
+            continue
+        scanned += 1
+        hits = myersScan(seq, tag, allowed_errors)
+        if not hits:
+            continue
+        best_errors = min(hits)[0]
+        best, last = None, None
+        for errors, end in hits:
+            # neighbouring ends share one alignment window
+            if errors != best_errors or (last and end - last <= 
+            allowed_errors):
+                continue
+            last = end
+            alignment = alignEnd(seq, tag, end, allowed_errors)
+            if best is None or alignment[0] > best[0]:
+                best = alignment
+        score, start, seq_match_span, tag_match_span = best
+        match, errors = matches(tag, seq_match_span, tag_match_span, 
+            allowed_errors)
+        key = (match, -errors, -rank[tag])
+        if match >= len(tag)-allowed_errors and errors <= allowed_errors and \
+        key > best_key:
+            best_key = key
+            # end, as for smithWaterman, is in alignment coordinates
+            stop = start + len(seq_match_span) - seq_match_span.count('-')
+            high_score['tag'] = tag
+            high_score['seq_match'] = seq[:start] + seq_match_span + seq[stop:]
+            high_score['start'] = start
+            high_score['end'] = start + len(seq_match_span)
+            high_score['matches'] = match
+            high_score['seq_match_span'] = seq_match_span
+            high_score['errors'] = errors
+            if errors == 0 and match >= longest and not [t for t in 
+            tags[i + 1:] if len(t) >= longest and rank[t] < rank[tag]]:
+                break
+    STATS.count('fuzzy scans', scanned)
+    STATS.count('fuzzy scans pruned', pruned)
+    if high_score['matches']:
+        return high_score['tag'], high_score['matches'], \
+        high_score['seq_match'], high_score['seq_match_span'], \
+        high_score['start'], high_score['end']
+    else:
+        return None
+
+def tagVariants(tag, bases='ACGTN'):
+    '''Return every sequence within one substitution, insertion or deletion 
+    of tag'''
+    variants = set()
+    for i in xrange(len(tag)):
+        variants.add(tag[:i] + tag[i+1:])
+        for b in bases:
+            if b != tag[i]:
+                variants.add(tag[:i] + b + tag[i+1:])
+            # insertions at the very ends are just an exact match + 1 base
+            if i > 0:
+                variants.add(tag[:i] + b + tag[i:])
+    variants.discard(tag)
+    return variants
+
+class Neighborhood(object):
+    '''Hash index of every 1-error variant of a set of tags, so that most 
+    fuzzy matches at the ends of a read are resolved by dict lookup rather 
+    than by alignment.  Each variant is aligned to its tag once, here, so a 
+    hit returns the same tuple as fuzzyMatch.  Variants within one error of 
+    more than one tag are kept in collisions and never resolved by lookup'''
+    def __init__(self, tags):
+        self.tags = list(tags)
+        self.index, self.collisions = {}, {}
+        for tag in self.tags:
+            for variant in tagVariants(tag):
+                score, start, seq_match_span, tag_match_span = \
+                alignEnd(variant, tag, len(variant), 1)
+                match, errors = matches(tag, seq_match_span, tag_match_span, 1)
+                if match < len(tag) - 1 or errors > 1:
+                    continue
+                entry = (tag, match, start, seq_match_span, score)
+                if variant in self.collisions:
+                    self.collisions[variant].append(tag)
+                elif variant in self.index and self.index[variant][0] != tag:
+                    self.collisions[variant] = [self.index.pop(variant)[0], tag]
+                else:
+                    self.index[variant] = entry
+        # exact tags that are also a variant of another tag are ambiguous too
+        for tag in self.tags:
+            if tag in self.index:
+                self.collisions[tag] = [self.index.pop(tag)[0], tag]
+        self.lengths = sorted(set([len(v) for v in self.index]))
+    
+    def _best(self, s, positions):
+        best = None
+        for pos, variant in positions:
+            if variant in self.collisions:
+                return None
+            entry = self.index.get(variant)
+            if entry and (best is None or entry[1] > best[1][1] or 
+            (entry[1] == best[1][1] and entry[4] > best[1][4])):
+                best = (pos, entry)
+        if not best:
+            return None
+        pos, (tag, match, start, seq_match_span, score) = best
+        start += pos
+        stop = start + len(seq_match_span) - seq_match_span.count('-')
+        return tag, match, s[:start] + seq_match_span + s[stop:], \
+        seq_match_span, start, start + len(seq_match_span)
+    
+    def left(self, s, max_gap_char=0):
+        '''Look up the 5' end of s, allowing up to max_gap_char leading bases.
+        Returns the same tuple as fuzzyMatch, or None when there is no hit or 
+        the hit is ambiguous'''
+        return self._best(s, [(o, s[o:o + l]) for o in xrange(max_gap_char + 1)
+            for l in self.lengths if o + l <= len(s)])
+    
+    def right(self, s, max_gap_char=0):
+        '''Look up the 3' end of s, allowing up to max_gap_char trailing bases.
+        Returns the same tuple as fuzzyMatch, or None when there is no hit or 
+        the hit is ambiguous'''
+        n = len(s)
+        return self._best(s, [(n - o - l, s[n - o - l:n - o]) for o in 
+            xrange(max_gap_char + 1) for l in self.lengths if n - o - l >= 0])
+    
+    def report(self, name=''):
+        '''Print the variants that map to more than one tag'''
+        print 'Tag neighborhood %s:  %s tags, %s variants, %s collisions' % (name,
+            len(self.tags), len(self.index), len(self.collisions))
+        for variant in sorted(self.collisions):
+            print '    %s -> %s' % (variant, ', '.join(self.collisions[variant]))
+
+class HammingMatcher(object):
+    '''Batch substitution-only matching of read ends against every tag in a 
+    TagSet.  The ends of a chunk of reads (covering every allowed offset) go
+    into a uint8 matrix, and mismatch counts against each tag at each offset
+    come from one broadcast comparison per tag base.  Exact hits resolve as 
+    the end regex would (the same tag and position), and a read with a single
+    1-mismatch hit resolves through the neighborhood; anything else is left 
+    (None) for leftLinker/rightLinker and the fuzzy aligner'''
+    def __init__(self, tagset):
+        self.tagset = tagset
+        # in alternation order, so ties go the way the regex would
+        self.left_tags = list(tagset.tags)
+        self.right_tags = list(tagset.revtags)
+        self.max_len = max([len(t) for t in self.left_tags])
+        # what the end regexes allow between the read end and the tag
+        self.gap_bases = numpy.zeros(256, dtype=bool)
+        self.gap_bases[numpy.frombuffer('acgtnACGTN', dtype=numpy.uint8)] = \
+            True
+    
+    def _mismatches(self, seqs, tags, gap, right=False):
+        '''Mismatch counts, as an (n reads, n tags, gap + 1 offsets) array - 
+        offsets count from the start (or, for right, the end) of each read.
+        Windows that run off the read count as len(tag) + 1 mismatches'''
+        width = gap + self.max_len
+        if right:
+            windows = ''.join([s[-width:].rjust(width, '\0') for s in seqs])
+        else:
+            windows = ''.join([s[:width].ljust(width, '\0') for s in seqs])
+        x = numpy.frombuffer(windows, dtype=numpy.uint8).reshape(len(seqs), 
+            width)
+        lengths = numpy.array([len(s) for s in seqs])[:, None]
+        offsets = numpy.arange(gap + 1)
+        counts = numpy.zeros((len(seqs), len(tags), gap + 1), dtype=numpy.int32)
+        for j, tag in enumerate(tags):
+            l = len(tag)
+            c = counts[:, j]
+            # compare one base of the tag against its column at every offset
+            for i, base in enumerate(numpy.frombuffer(tag, dtype=numpy.uint8)):
+                if right:
+                    # offset o from the end puts base i at width - l - o + i
+                    c += x[:, width - l + i - gap:width - l + i + 1][:, ::-1] \
+                        != base
+                else:
+                    c += x[:, i:i + gap + 1] != base
+            c[lengths < offsets + l] = l + 1
+        return counts
+    
+    def _gaps(self, seqs, gap, right=False):
+        '''Which offsets leave only gap_bases between the (start or, for 
+        right, end of the) read and the tag, as an (n reads, gap + 1) 
+        array'''
+        if right:
+            ends = ''.join([s[max(len(s) - gap, 0):][::-1].ljust(gap, '\0') 
+                for s in seqs])
+        else:
+            ends = ''.join([s[:gap].ljust(gap, '\0') for s in seqs])
+        x = numpy.frombuffer(ends, dtype=numpy.uint8).reshape(len(seqs), gap)
+        valid = numpy.ones((len(seqs), gap + 1), dtype=bool)
+        valid[:, 1:] = numpy.logical_and.accumulate(self.gap_bases[x], 1)
+        return valid
+    
+    def _resolve(self, seqs, tags, gap, neighborhood, right=False):
+        counts = self._mismatches(seqs, tags, gap, right)
+        n, k = counts.shape[:2]
+        lengths = numpy.array([len(t) for t in tags])
+        # the end regexes take the exact hit starting furthest into the read
+        # (5') or nearest its start (3'), then the first tag in order - at 
+        # an offset that leaves nothing but gap_bases before it
+        reach = numpy.arange(gap + 1)[None, :] + right * lengths[:, None]
+        rank = reach * k + (k - 1 - numpy.arange(k))[:, None]
+        zero = counts == 0
+        valid = self._gaps(seqs, gap, right)[:, None, :]
+        exact = numpy.where(zero & valid, rank, -1).reshape(n, -1)
+        best = exact.argmax(1)
+        found = exact.max(1) >= 0
+        # an exact hit the regex can't reach goes to the fuzzy aligner, 
+        # which will see it - so leave those reads to leftLinker/rightLinker
+        masked = (zero & ~valid).reshape(n, -1).any(1)
+        single = (counts == 1).reshape(n, -1)
+        n_single = single.sum(1)
+        first = single.argmax(1)
+        results = []
+        for i, s in enumerate(seqs):
+            if found[i]:
+                j, o = divmod(best[i], gap + 1)
+                tag = tags[j]
+                # the regex match includes the gap
+                if right:
+                    results.append((tag, 'regex', len(s) - o - len(tag), 
+                        len(s), tag))
+                else:
+                    results.append((tag, 'regex', 0, o + len(tag), tag))
+                continue
+            if masked[i] or n_single[i] != 1:
+                results.append(None)
+                continue
+            j, o = divmod(first[i], gap + 1)
+            start = right and len(s) - o - len(tags[j]) or o
+            variant = s[start:start + len(tags[j])]
+            if variant in neighborhood.collisions or variant not in \
+            neighborhood.index:
+                results.append(None)
+                continue
+            match = neighborhood._best(s, [(start, variant)])
+            start, stop = SWMatchPos(match[3], match[4], match[5])
+            results.append((match[0], 'fuzzy', start, stop, match[3]))
+        return results
+    
+    def left(self, seqs):
+        '''Resolve the 5' ends of seqs.  Returns, per read, what leftLinker 
+        would, or None if unresolved'''
+        return self._resolve(seqs, self.left_tags, self.tagset.left_gap, 
+            self.tagset.neighborhood)
+    
+    def right(self, seqs):
+        '''Resolve the 3' ends of seqs.  Returns, per read, what rightLinker 
+        would, or None if unresolved'''
+        results = self._resolve(seqs, self.right_tags, self.tagset.right_gap,
+            self.tagset.rev_neighborhood, right=True)
+        return [r and (self.tagset.revtags[r[0]],) + r[1:] for r in results]
+
 def qualTrimming(record, min_score=10):
     '''Remove ambiguous bases from 5' and 3' sequence ends'''
     s = str(record.seq)
     sl = list(s)
-    for q in enumerate(record.letter_annotations["phred_quality"]):
+    for q in enumerate(phredQuality(record)):
         if q[1] < min_score:
             sl[q[0]] = 'N'
     s = ''.join(sl)
@@ -130,12 +894,106 @@ def qualTrimming(record, min_score=10):
         right_trim = right_trim.end()
     return trim(record, left_trim, right_trim)
 
-def midTrim(record, tags, max_gap_char=22, **kwargs):
-    '''Remove the MID tag from the sequence read'''
+def qualTrimBatch(records, min_score=10):
+    '''Vectorized qualTrimming for a batch of records.  Bases and qualities 
+    are packed into padded uint8 matrices (one row per read) and the trim 
+    points and N counts of every read are computed at once.  Returns arrays 
+    of left and right trim offsets and N_count which match qualTrimming'''
+    lengths = numpy.array([len(r.seq) for r in records], dtype=int)
+    width = max(lengths.max(), 1) if len(records) else 1
+    quals = numpy.zeros((len(records), width), dtype=numpy.uint8)
+    bases = numpy.zeros((len(records), width), dtype=numpy.uint8)
+    for i, r in enumerate(records):
+        q = phredQuality(r)
+        if isinstance(q, array.array):
+            q = numpy.frombuffer(q, dtype=numpy.uint8)
+        quals[i, :lengths[i]] = q
+        bases[i, :lengths[i]] = numpy.frombuffer(str(r.seq), dtype=numpy.uint8)
+    positions = numpy.arange(width)
+    n_base = bases == ord('N')
+    good = (positions < lengths[:, None]) & ~n_base & (quals >= min_score)
+    # 5' trim point is the first good base (or the end, if there isn't one)
+    left = numpy.where(good.any(1), good.argmax(1), lengths)
+    # qualTrimming uses the end() of the 3' run of N's, which is always the 
+    # end of the read, so there is nothing to trim from the 3' end
+    right = lengths.copy()
+    n_count = (n_base & (positions >= left[:, None])).sum(1)
+    return left, right, n_count
+
+def qualTrimRecords(records, min_score=10):
+    '''Quality trim a batch of records with qualTrimBatch, returning a list 
+    of (trimmed record, N_count)'''
+    left, right, n_count = qualTrimBatch(records, min_score)
+    return [(trim(r, int(left[i]), int(right[i])), int(n_count[i])) for i, r 
+        in enumerate(records)]
+
+class ReadFilter(object):
+    '''Screens a batch of quality trimmed reads before the MID and linker 
+    search, so reads that can't hold a MID + linker don't go through it (and
+    the fuzzy fallback).  With a window, each read is first cut at the start
+    of the first window bases whose mean quality is below window_score.  Reads
+    shorter than min_length, or with more than max_n (a fraction) N's, are 
+    then rejected'''
+    def __init__(self, min_length=0, max_n=1., window=0, window_score=10):
+        self.min_length = min_length
+        self.max_n = max_n
+        self.window = window
+        self.window_score = window_score
+    
+    def windowTrim(self, trimmed):
+        '''Sliding window trim a batch of (trimmed record, N_count)'''
+        records = [t[0] for t in trimmed]
+        lengths = numpy.array([len(r.seq) for r in records], dtype=int)
+        width = max(lengths.max(), self.window) if len(records) else 1
+        sums = numpy.zeros((len(records), width + 1), dtype=numpy.int32)
+        for i, r in enumerate(records):
+            q = phredQuality(r)
+            if isinstance(q, array.array):
+                q = numpy.frombuffer(q, dtype=numpy.uint8)
+            sums[i, 1:lengths[i] + 1] = numpy.cumsum(q)
+        # total quality of the window starting at each base
+        w = self.window
+        totals = sums[:, w:] - sums[:, :-w]
+        starts = numpy.arange(width - w + 1)
+        low = (starts + w <= lengths[:, None]) & \
+            (totals < self.window_score * w)
+        cut = numpy.where(low.any(1), low.argmax(1), lengths)
+        result = []
+        for i, (record, n_count) in enumerate(trimmed):
+            if cut[i] < lengths[i]:
+                record = record[:int(cut[i])]
+                n_count = str(record.seq).count('N')
+            result.append((record, n_count))
+        return result
+    
+    def screen(self, trimmed):
+        '''Screen a batch of (trimmed record, N_count), as returned by 
+        qualTrimRecords.  Returns the (possibly window trimmed) batch and, 
+        per read, why it was rejected ('too-short' or 'too-many-N') or 
+        None'''
+        if self.window:
+            trimmed = self.windowTrim(trimmed)
+        reasons = []
+        for record, n_count in trimmed:
+            length = len(record.seq)
+            if length < self.min_length:
+                reasons.append('too-short')
+            elif n_count > self.max_n * length:
+                reasons.append('too-many-N')
+            else:
+                reasons.append(None)
+        return trimmed, reasons
+
+def midTrim(record, tags, **kwargs):
+    '''Remove the MID tag (tags is a TagSet) from the sequence read'''
     #if record.id == 'MID_No_Error_ATACGACGTA':
     #    pdb.set_trace()
     s = str(record.seq)
-    mid = leftLinker(s, tags, max_gap_char, True, fuzzy=kwargs['fuzzy'])
+    # the match may already have been found in a batch (see batchMatch)
+    if 'hit' in kwargs:
+        mid = kwargs['hit']
+    else:
+        mid = leftLinker(s, tags, fuzzy=kwargs['fuzzy'])
     if mid:
         trimmed = trim(record, mid[3])
         tag, m_type, seq_match = mid[0], mid[1], mid[4]
@@ -151,76 +1009,165 @@ def SWMatchPos(seq_match_span, start, stop):
         stop = stop - seq_match_span.count('-')
     return start, stop
 
-def leftLinker(s, tags, max_gap_char, gaps=False, **kwargs):
+class LRUCache(object):
+    '''Bounded least-recently-used cache - a dict of links in a circular, 
+    doubly linked list (oldest first).  get returns None on a miss'''
+    def __init__(self, size):
+        self.size = size
+        self.links = {}
+        # [previous, next, key, value]
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+    
+    def get(self, key):
+        link = self.links.get(key)
+        if link is None:
+            return None
+        # move to the newest end
+        previous, next = link[0], link[1]
+        previous[1], next[0] = next, previous
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0], link[1] = last, root
+        return link[3]
+    
+    def put(self, key, value):
+        '''Add key (which must not be cached), returning True if the oldest
+        entry was evicted to make room'''
+        root = self.root
+        evicted = len(self.links) >= self.size
+        if evicted:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.links[oldest[2]]
+        last = root[0]
+        last[1] = root[0] = self.links[key] = [last, root, key, value]
+        return evicted
+
+def leftEnd(s, tags):
+    '''Regex, then 1-error neighborhood, match of the 5' end of s.  Returns 
+    (method, match) - match as leftLinker returns it, or None'''
+    match = tags.left_regex.search(s)
+    if match:
+        tag = match.group(1)
+        return 'regex', (tag, 'regex', match.start(), match.end(), tag)
+    match = tags.neighborhood.left(s, tags.left_gap)
+    if match:
+        start, stop = SWMatchPos(match[3], match[4], match[5])
+        return 'neighborhood', (match[0], 'fuzzy', start, stop, match[3])
+    return 'none', None
+
+def rightEnd(s, tags):
+    '''As leftEnd, for the 3' end of s.  The tag is the reverse complement 
+    and the positions count back from the end of s (so are negative)'''
+    n = len(s)
+    match = tags.right_regex.search(s)
+    if match:
+        tag = match.group(1)
+        return 'regex', (tag, 'regex', match.start() - n, match.end() - n, 
+            tag)
+    match = tags.rev_neighborhood.right(s, tags.right_gap)
+    if match:
+        start, stop = SWMatchPos(match[3], match[4], match[5])
+        return 'neighborhood', (match[0], 'fuzzy', start - n, stop - n, 
+            match[3])
+    return 'none', None
+
+def cachedEnd(s, tags, end):
+    '''leftEnd or rightEnd (end is 'left' or 'right') of s.  Neither looks 
+    past the bases in that end's window, so results are memoized on the 
+    window in the TagSet's LRU cache (if it has one)'''
+    if end == 'left':
+        cache, lookup, window = tags.left_cache, leftEnd, s[:tags.left_window]
+    else:
+        cache, lookup, window = tags.right_cache, rightEnd, \
+            s[-tags.right_window:]
+    if cache is None:
+        return lookup(s, tags)
+    result = cache.get(window)
+    if result is None:
+        STATS.count('%s %s cache miss' % (tags.kind, end))
+        result = lookup(s, tags)
+        if cache.put(window, result):
+            STATS.count('%s %s cache eviction' % (tags.kind, end))
+    else:
+        STATS.count('%s %s cache hit' % (tags.kind, end))
+    return result
+
+def leftLinker(s, tags, **kwargs):
     '''Mathing methods for left linker - regex first, followed by fuzzy (SW)
-    alignment, if the option is passed'''
-    for tag in tags:
-        if gaps:
-            r = re.compile(('^%s') % (tag))
-        else:
-            r = re.compile(('^[acgtnACGTN]{0,%s}%s') % (max_gap_char, tag))
-        match = re.search(r, s)
-        if match:
-            m_type = 'regex'
-            start, stop = match.start(), match.end()
-            # by default, this is true
-            seq_match = tag
-            break
-    #if s == 'ACCTCGTGCGGAATCGAGAGAGAGAGAGAGAGAGAGAGAGAGAGAGAGAGAG':
-    #    pdb.set_trace()
-    if not match and kwargs['fuzzy']:
-        match = smithWaterman(s, tags, 1)
-        # we can trim w/o regex
+    alignment, if the option is passed.  tags is a TagSet'''
+    if kwargs['fuzzy']:
+        # 1-error variants are (mostly) a lookup, alignment is the fallback
+        method, match = cachedEnd(s, tags, 'left')
+        if not match:
+            begin = time.time()
+            match = fuzzyMatch(s, tags.order, 1, tags.rank)
+            STATS.time('fuzzyMatch', time.time() - begin)
+            method = 'fuzzy'
+            # we can trim w/o regex
+            if match:
+                start, stop = SWMatchPos(match[3],match[4], match[5])
+                match = match[0], 'fuzzy', start, stop, match[3]
+    else:
+        method, match = 'regex', tags.left_regex.search(s)
         if match:
-            m_type = 'fuzzy'
-            tag = match[0]
-            seq_match = match[3]
-            start, stop = SWMatchPos(match[3],match[4], match[5])
+            tag = match.group(1)
+            match = tag, 'regex', match.start(), match.end(), tag
     if match:
-        return tag, m_type, start, stop, seq_match
+        STATS.count('%s left %s' % (tags.kind, method))
+        tags.hit(match[0])
+        return match
     else:
+        STATS.count('%s left none' % tags.kind)
         return None
 
-def rightLinker(s, tags, max_gap_char, gaps=False, **kwargs):
+def rightLinker(s, tags, **kwargs):
     '''Mathing methods for right linker - regex first, followed by fuzzy (SW)
-    alignment, if the option is passed'''
+    alignment, if the option is passed.  tags is a TagSet'''
     #if s == 'GAGAGAGAGAGAGAGAGAGAGAGAGAGAGAGAGAGAG':
     #    pdb.set_trace()
-    revtags = revCompTags(tags)
-    for tag in revtags:
-        if gaps:
-            r = re.compile(('%s$') % (tag))
-        else:
-            r = re.compile(('%s[acgtnACGTN]{0,%s}$') % (tag, max_gap_char))
-        match = re.search(r, s)
+    if kwargs['fuzzy']:
+        method, match = cachedEnd(s, tags, 'right')
         if match:
-            m_type = 'regex'
-            start, stop = match.start(), match.end()
-            # by default, this is true
-            seq_match = tag
-            break
-    if not match and kwargs['fuzzy']:
-        match = smithWaterman(s, revtags, 1)
-        # we can trim w/o regex
+            n = len(s)
+            match = match[:2] + (match[2] + n, match[3] + n, match[4])
+        else:
+            begin = time.time()
+            match = fuzzyMatch(s, tags.rev_order, 1, tags.rev_rank)
+            STATS.time('fuzzyMatch', time.time() - begin)
+            method = 'fuzzy'
+            if match:
+                start, stop = SWMatchPos(match[3],match[4], match[5])
+                match = match[0], 'fuzzy', start, stop, match[3]
+    else:
+        method, match = 'regex', tags.right_regex.search(s)
         if match:
-            m_type = 'fuzzy'
-            tag = match[0]
-            seq_match = match[3]
-            start, stop = SWMatchPos(match[3],match[4], match[5])
+            tag = match.group(1)
+            match = tag, 'regex', match.start(), match.end(), tag
     if match:
-        return revComp(tag), m_type, start, stop, seq_match
+        STATS.count('%s right %s' % (tags.kind, method))
+        tag = tags.revtags[match[0]]
+        tags.hit(tag)
+        return (tag,) + match[1:]
     else:
+        STATS.count('%s right none' % tags.kind)
         return None
 
-def linkerTrim(record, tags, max_gap_char=22, **kwargs):
+def linkerTrim(record, tags, **kwargs):
     '''Use regular expression and (optionally) fuzzy string matching
-    to locate and trim linkers from sequences'''
+    to locate and trim linkers (a TagSet) from sequences'''
     #if record.id == 'FX5ZTWB02DOPOT':
     #    pdb.set_trace()
     m_type  = False
     s       = str(record.seq)
-    left    = leftLinker(s, tags, max_gap_char=22, fuzzy=kwargs['fuzzy'])
-    right   = rightLinker(s, tags, max_gap_char=22, fuzzy=kwargs['fuzzy'])
+    max_gap_char = tags.max_gap_char
+    # either end may already have been found in a batch (see batchMatch)
+    left    = kwargs.get('left') or leftLinker(s, tags, fuzzy=kwargs['fuzzy'])
+    right   = kwargs.get('right') or rightLinker(s, tags, 
+        fuzzy=kwargs['fuzzy'])
     if left and right and left[0] == right[0]:
         # we can have lots of conditional matches here
         if left[2] <= max_gap_char and right[2] >= (len(s) - (len(right[0]) +\
@@ -254,7 +1201,7 @@ def linkerTrim(record, tags, max_gap_char=22, **kwargs):
             pass
     if m_type:
         try:
-            return tag, trimmed, seq_match, tags[tag], m_type
+            return tag, trimmed, seq_match, tags.tags[tag], m_type
         except:
             return tag, trimmed, seq_match, None, m_type
     else:
@@ -268,141 +1215,542 @@ def reverse(items):
         l.append(t)
     return dict(l)
 
-def createSeqTable(c):
+def createSeqTable(c, keep=False, split=False, defer=False):
     '''Create necessary tables in our database to hold the sequence and 
-    tagging data'''
-    # TODO:  move blob column to its own table, indexed by id
+    tagging data.  With keep, an existing table (and its data) is kept.  With
+    split, the record BLOBs go in their own table (sequence_record) keyed by
+    id.  With defer, the secondary indexes are left to createIndexes, after
+    the load'''
+    # DONE:  move blob column to its own table, indexed by id (split)
     # DONE:  move all tables to InnoDB??
-    try:
-        c.execute('''DROP TABLE sequence''')
-    except:
-        pass
-    c.execute('''CREATE TABLE sequence (id INT UNSIGNED NOT NULL 
+    if not keep:
+        try:
+            c.execute('''DROP TABLE sequence''')
+        except:
+            pass
+    c.execute('''CREATE TABLE IF NOT EXISTS sequence (id INT UNSIGNED NOT NULL 
         AUTO_INCREMENT,name VARCHAR(100),mid VARCHAR(30),mid_seq VARCHAR(30),
         mid_match VARCHAR(30),mid_method VARCHAR(50),linker VARCHAR(50),
         linker_seq VARCHAR(50),linker_match VARCHAR(50),linker_method 
         VARCHAR(50),cluster VARCHAR(75),concat_seq VARCHAR(50), 
         concat_match varchar(50), concat_method VARCHAR(50),
         n_count SMALLINT UNSIGNED, untrimmed_len SMALLINT UNSIGNED, 
-        seq_trimmed TEXT, trimmed_len SMALLINT UNSIGNED, record BLOB, PRIMARY
-        KEY (id), INDEX sequence_cluster (cluster)) ENGINE=InnoDB''')
+        seq_trimmed TEXT, trimmed_len SMALLINT UNSIGNED, reject_reason 
+        VARCHAR(50)%s, PRIMARY KEY (id)) ENGINE=InnoDB''' % (not split and ', record BLOB' or ''))
+    createRecordTable(c, keep, split, 'BLOB')
+    if not defer:
+        createIndexes(c, INDEXES[LINKER_INSERT])
+    createCheckpointTable(c, keep)
 
-def createQualSeqTable(c):
-    # TODO:  move blob column to its own table, indexed by id
+def createQualSeqTable(c, keep=False, split=False, defer=False):
+    # DONE:  move blob column to its own table, indexed by id (split)
     # DONE:  move all tables to InnoDB??
-    try:
-        c.execute('''DROP TABLE sequence''')
-    except:
-        pass
-    c.execute('''CREATE TABLE sequence (id INT UNSIGNED NOT NULL 
+    if not keep:
+        try:
+            c.execute('''DROP TABLE sequence''')
+        except:
+            pass
+    c.execute('''CREATE TABLE IF NOT EXISTS sequence (id INT UNSIGNED NOT NULL 
         AUTO_INCREMENT,name VARCHAR(100), n_count SMALLINT UNSIGNED, 
         untrimmed_len MEDIUMINT UNSIGNED, seq_trimmed MEDIUMTEXT, trimmed_len 
-        MEDIUMINT UNSIGNED, record MEDIUMBLOB, PRIMARY KEY (id)) ENGINE=InnoDB''')
+        MEDIUMINT UNSIGNED%s, PRIMARY KEY (id)) ENGINE=InnoDB''' % 
+        (not split and ', record MEDIUMBLOB' or ''))
+    createRecordTable(c, keep, split, 'MEDIUMBLOB')
+    if not defer:
+        createIndexes(c, INDEXES[QUAL_INSERT])
+    createCheckpointTable(c, keep)
+
+def createRecordTable(c, keep=False, split=False, blob='BLOB'):
+    '''Create the table holding the record BLOBs for the split schema (and 
+    drop any old one)'''
+    if not keep:
+        c.execute('''DROP TABLE IF EXISTS sequence_record''')
+    if split:
+        c.execute('''CREATE TABLE IF NOT EXISTS sequence_record (id INT 
+            UNSIGNED NOT NULL, record %s, PRIMARY KEY (id)) ENGINE=InnoDB''' % 
+            blob)
 
-def concatCheck(record, all_tags, all_tags_regex, reverse_linkers, **kwargs):
+def createIndexes(c, indexes):
+    '''Add whichever of indexes (a list of (name, column)) the sequence table
+    does not have yet, in a single ALTER TABLE'''
+    c.execute('''SHOW INDEX FROM sequence''')
+    # Key_name is the third column
+    existing = set([row[2] for row in c.fetchall()])
+    missing = ['ADD INDEX %s (%s)' % index for index in indexes if index[0] 
+        not in existing]
+    if missing:
+        c.execute('''ALTER TABLE sequence %s''' % ', '.join(missing))
+
+def createCheckpointTable(c, keep=False):
+    '''Create the table of per-input checkpoints (how many reads of each input
+    file are stored, and whether it is complete)'''
+    if not keep:
+        c.execute('''DROP TABLE IF EXISTS checkpoint''')
+    c.execute('''CREATE TABLE IF NOT EXISTS checkpoint (input VARCHAR(255) NOT 
+        NULL, stored INT UNSIGNED, complete TINYINT(1), updated TIMESTAMP 
+        DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, PRIMARY KEY 
+        (input)) ENGINE=InnoDB''')
+
+class ConcatScanner(object):
+    '''Find every internal occurrence (exact or within allowed_errors) of a 
+    set of tags in one pass over a read.  Each tag is cut into 
+    allowed_errors + 1 seeds - any occurrence with <= allowed_errors errors
+    contains at least one of them exactly - and the seeds are searched for 
+    together with one compiled alternation per seed length.  Seed hits are 
+    then verified with myersScan/alignEnd in a window around the hit'''
+    def __init__(self, tags, allowed_errors=1):
+        self.tags = sorted(set(tags))
+        self.allowed_errors = allowed_errors
+        self.seeds = {}
+        for tag in self.tags:
+            size = len(tag) // (allowed_errors + 1)
+            for i in xrange(allowed_errors + 1):
+                start = i * size
+                if i == allowed_errors:
+                    seed = tag[start:]
+                else:
+                    seed = tag[start:start + size]
+                self.seeds.setdefault(seed, []).append((tag, start))
+        lengths = sorted(set([len(seed) for seed in self.seeds]))
+        # lookahead, so that overlapping seed hits are all reported
+        self.regexes = [re.compile('(?=(%s))' % '|'.join([seed for seed in 
+            self.seeds if len(seed) == l])) for l in lengths]
+    
+    def scan(self, s):
+        '''Return a list of (errors, start, tag, seq_match_span) for each tag
+        occurrence in s, in order of position'''
+        k = self.allowed_errors
+        candidates = set()
+        for regex in self.regexes:
+            for match in regex.finditer(s):
+                for tag, offset in self.seeds[match.group(1)]:
+                    candidates.add((tag, match.start() - offset))
+        found = {}
+        for tag, start in candidates:
+            offset = max(0, start - k)
+            window = s[offset:start + len(tag) + k]
+            hits = myersScan(window, tag, k)
+            if not hits:
+                continue
+            errors, end = min(hits)
+            score, begin, seq_match_span, tag_match_span = alignEnd(window, 
+                tag, end, k)
+            match, errors = matches(tag, seq_match_span, tag_match_span, k)
+            if match >= len(tag) - k and errors <= k:
+                found[(offset + begin, tag)] = (errors, offset + begin, tag, 
+                    seq_match_span)
+        return sorted(found.values(), key=lambda f:f[1])
+
+def sqliteConnect(path):
+    '''Connect to a SQLite database, set up for bulk loading'''
+    conn = sqlite3.connect(path)
+    conn.text_factory = str
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def createSeqTableSQLite(c, keep=False, split=False, defer=False):
+    '''SQLite version of createSeqTable'''
+    if not keep:
+        c.execute('''DROP TABLE IF EXISTS sequence''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sequence (id INTEGER PRIMARY KEY 
+        AUTOINCREMENT, name VARCHAR(100),mid VARCHAR(30),mid_seq VARCHAR(30),
+        mid_match VARCHAR(30),mid_method VARCHAR(50),linker VARCHAR(50),
+        linker_seq VARCHAR(50),linker_match VARCHAR(50),linker_method 
+        VARCHAR(50),cluster VARCHAR(75),concat_seq VARCHAR(50), 
+        concat_match varchar(50), concat_method VARCHAR(50),
+        n_count INTEGER, untrimmed_len INTEGER, seq_trimmed TEXT, 
+        trimmed_len INTEGER, reject_reason VARCHAR(50)%s)''' % (not split 
+        and ', record BLOB' or ''))
+    createRecordTableSQLite(c, keep, split)
+    if not defer:
+        createIndexesSQLite(c, INDEXES[LINKER_INSERT])
+    createCheckpointTableSQLite(c, keep)
+
+def createQualSeqTableSQLite(c, keep=False, split=False, defer=False):
+    '''SQLite version of createQualSeqTable'''
+    if not keep:
+        c.execute('''DROP TABLE IF EXISTS sequence''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sequence (id INTEGER PRIMARY KEY 
+        AUTOINCREMENT, name VARCHAR(100), n_count INTEGER, untrimmed_len 
+        INTEGER, seq_trimmed TEXT, trimmed_len INTEGER%s)''' % (not split and 
+        ', record BLOB' or ''))
+    createRecordTableSQLite(c, keep, split)
+    if not defer:
+        createIndexesSQLite(c, INDEXES[QUAL_INSERT])
+    createCheckpointTableSQLite(c, keep)
+
+def createRecordTableSQLite(c, keep=False, split=False):
+    '''SQLite version of createRecordTable'''
+    if not keep:
+        c.execute('''DROP TABLE IF EXISTS sequence_record''')
+    if split:
+        c.execute('''CREATE TABLE IF NOT EXISTS sequence_record (id INTEGER 
+            PRIMARY KEY, record BLOB)''')
+
+def createIndexesSQLite(c, indexes):
+    '''SQLite version of createIndexes'''
+    for index in indexes:
+        c.execute('''CREATE INDEX IF NOT EXISTS %s ON sequence (%s)''' % index)
+
+def createCheckpointTableSQLite(c, keep=False):
+    '''SQLite version of createCheckpointTable'''
+    if not keep:
+        c.execute('''DROP TABLE IF EXISTS checkpoint''')
+    c.execute('''CREATE TABLE IF NOT EXISTS checkpoint (input VARCHAR(255) NOT 
+        NULL PRIMARY KEY, stored INTEGER, complete INTEGER, updated TEXT)''')
+
+def concatCheck(record, scanner, **kwargs):
     '''Check screened sequence for the presence of concatemers by scanning 
-    for all possible tags - after the 5' and 3' tags have been removed'''
+    for all possible tags (with a ConcatScanner) - after the 5' and 3' tags 
+    have been removed.  Exact hits are preferred to fuzzy ones'''
     s = str(record.seq)
-    m_type = None
-    # do either/or to try and keep speed up, somewhat
-    #if not kwargs['fuzzy']:
-    #pdb.set_trace()
-    for tag in all_tags_regex:
-        match = re.search(tag, s)
-        if match:
-            tag = tag.pattern
-            m_type = 'regex-concat'
-            seq_match = tag
-            break
-    if not match and ['fuzzy']:
-    #else:
-        match = smithWaterman(s, all_tags, 1)
-        # we can trim w/o regex
-        if match:
-            tag = match[0]
-            m_type = 'fuzzy-concat'
-            seq_match = match[3]
-    if m_type:
-        return tag, m_type, seq_match
+    hits = scanner.scan(s)
+    if not kwargs['fuzzy']:
+        hits = [h for h in hits if h[0] == 0]
+    if hits:
+        errors, start, tag, seq_match = min(hits)
+        if errors == 0:
+            return tag, 'regex-concat', tag
+        return tag, 'fuzzy-concat', seq_match
     else:
         return None, None, None
 
-def sequenceCount(input):
-    '''Determine the number of sequence reads in the input'''
-    handle = open(input, 'rU')
-    lines = handle.read().count('>')
+def sequenceCount(input, blocksize=1048576, fastq=False):
+    '''Determine the number of sequence reads in the input (FASTA, or FASTQ
+    with fastq).  The file is scanned in blocks of blocksize bytes, so memory
+    use stays flat no matter how large the input is.  For compressed input 
+    we only estimate, from the first block, rather than inflate it twice'''
+    if fastq:
+        count = lambda block: block.count('\n') / 4.
+    else:
+        count = lambda block: block.count('>')
+    handle = open(input, 'rb')
+    extension = os.path.splitext(input)[1]
+    if extension in COMPRESSED:
+        block = handle.read(blocksize)
+        handle.close()
+        # the block may hold several gzip members/bzip2 streams - start over 
+        # on whatever follows the end of one, as DecompressingReader does
+        rest, sample, d = block, [], COMPRESSED[extension]()
+        while rest:
+            try:
+                sample.append(d.decompress(rest))
+            except EOFError:
+                d = COMPRESSED[extension]()
+                continue
+            rest = d.unused_data
+            if rest:
+                d = COMPRESSED[extension]()
+        return int(count(''.join(sample)) * os.path.getsize(input) / 
+            max(len(block), 1))
+    lines = 0
+    while True:
+        block = handle.read(blocksize)
+        if not block:
+            break
+        lines += count(block)
     handle.close()
-    return lines
+    return int(lines)
             
 
-def qualOnlyWorker(record, qual, conf):
-    # we need a separate connection for each mysql cursor or they are going
-    # start going into locking hell and things will go poorly. Creating a new 
-    # connection for each worker process is the easiest/laziest solution.
-    # Connection pooling (DB-API) didn't work so hot, but probably because 
-    # I'm slightly retarded.
-    conn = MySQLdb.connect(user=conf.get('Database','USER'), 
-        passwd=conf.get('Database','PASSWORD'), 
-        db=conf.get('Database','DATABASE'))
-    cur = conn.cursor()
+class _Profiled(object):
+    '''Adapter so pstats.Stats can load a merged cProfile stats dict'''
+    def __init__(self, stats):
+        self.stats = stats
+    
+    def create_stats(self):
+        pass
+
+class RunStats(object):
+    '''Counters and timers for a run.  Every process keeps its own (STATS) 
+    - the workers ship a snapshot() back with each chunk of rows and the 
+    parent merge()s them.  Timers hold [calls, seconds].  With a profile_rate
+    (0 - 1), that fraction of reads is run under cProfile'''
+    def __init__(self):
+        self.counts = {}
+        self.timers = {}
+        self.profile_every = 0
+        self.profiler = None
+        self.profiled = 0
+        self.seen = 0
+        self.profile = {}
+    
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+    
+    def time(self, name, seconds):
+        t = self.timers.get(name)
+        if t is None:
+            self.timers[name] = [1, seconds]
+        else:
+            t[0] += 1
+            t[1] += seconds
+    
+    def profileRate(self, rate):
+        '''Profile every 1/rate-th read'''
+        if rate > 0:
+            self.profile_every = max(int(round(1. / rate)), 1)
+    
+    def run(self, worker, *args):
+        '''Call worker(*args), under cProfile for sampled reads'''
+        self.seen += 1
+        if self.profile_every and self.seen % self.profile_every == 0:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiled += 1
+            return self.profiler.runcall(worker, *args)
+        return worker(*args)
+    
+    def snapshot(self):
+        '''Take (and reset) the counters, timers and profile so far'''
+        if self.profiler is not None:
+            self.profiler.create_stats()
+            self.mergeProfile(self.profiler.stats)
+            self.profiler = None
+        snapshot = (self.counts, self.timers, self.profiled, self.profile)
+        self.counts, self.timers, self.profiled, self.profile = {}, {}, 0, {}
+        return snapshot
+    
+    def mergeProfile(self, stats):
+        for func, stat in stats.items():
+            if func in self.profile:
+                self.profile[func] = pstats.add_func_stats(self.profile[func],
+                    stat)
+            else:
+                self.profile[func] = stat
+    
+    def merge(self, snapshot):
+        '''Add a snapshot from another process'''
+        counts, timers, profiled, profile = snapshot
+        for name, n in counts.items():
+            self.count(name, n)
+        for name, (calls, seconds) in timers.items():
+            t = self.timers.setdefault(name, [0, 0.])
+            t[0] += calls
+            t[1] += seconds
+        self.profiled += profiled
+        self.mergeProfile(profile)
+    
+    def rejectedTime(self):
+        '''Estimate the search time saved by the ReadFilter - the rejected 
+        reads at the mean MID + linker search time of the reads searched'''
+        rejected = self.counts.get('rejected', 0)
+        searched = self.counts.get('reads', 0) - rejected
+        if not searched:
+            return 0.
+        seconds = sum([self.timers.get(name, (0, 0.))[1] for name in 
+            ('batchMatch', 'midTrim', 'linkerTrim', 'concatCheck')])
+        return rejected * seconds / searched
+    
+    def asDict(self):
+        return {'counts':self.counts, 'timers':dict([(name, {'calls':t[0], 
+            'seconds':t[1]}) for name, t in self.timers.items()]), 
+            'profiled_reads':self.profiled}
+    
+    def report(self, writer=None, elapsed=None, json_path=None, 
+    profile_path=None):
+        '''Print the run summary and, optionally, write it as JSON to 
+        json_path and the combined cProfile stats to profile_path'''
+        # fold in reads profiled in this process
+        self.merge(self.snapshot())
+        reads = self.counts.get('reads', 0)
+        print 'Run report:  %s reads' % reads
+        if elapsed:
+            print '    %.1f reads/sec overall (%.1f sec)' % (reads / elapsed, 
+                elapsed)
+        print '    %-28s %10s %10s %12s' % ('timer', 'calls', 'sec', 
+            'usec/call')
+        for name, (calls, seconds) in sorted(self.timers.items()):
+            print '    %-28s %10s %10.3f %12.1f' % (name, calls, seconds, 
+                1e6 * seconds / max(calls, 1))
+        print '    %-28s %10s %10s' % ('counter', 'count', '% reads')
+        for name, n in sorted(self.counts.items()):
+            print '    %-28s %10s %10.2f' % (name, n, 100. * n / max(reads, 1))
+        if self.counts.get('rejected'):
+            print '    %s reads rejected before the MID/linker search (~%.1f ' \
+            'sec saved)' % (self.counts['rejected'], self.rejectedTime())
+        if writer:
+            writerReport(writer)
+        if self.profile:
+            profile = pstats.Stats(_Profiled(self.profile))
+            print 'Profile of %s sampled reads (top 15 by cumulative time)' % \
+            self.profiled
+            profile.sort_stats('cumulative').print_stats(15)
+            if profile_path:
+                profile.dump_stats(profile_path)
+        if json_path:
+            report = self.asDict()
+            report.update(writer=writer, elapsed=elapsed, 
+                rejected_seconds_saved=self.rejectedTime())
+            handle = open(json_path, 'w')
+            json.dump(report, handle, indent=2, sort_keys=True)
+            handle.close()
+
+# per-process run statistics (see RunStats)
+STATS = RunStats()
+
+def reportSettings(conf):
+    '''The run report settings from [Report]:  the JSON path, the fraction of
+    reads to profile and where to write the profile'''
+    json_path, rate, profile_path = None, 0., None
+    if conf.has_option('Report', 'JSON'):
+        json_path = conf.get('Report', 'JSON')
+    if conf.has_option('Report', 'PROFILE_RATE'):
+        rate = conf.getfloat('Report', 'PROFILE_RATE')
+    if conf.has_option('Report', 'PROFILE'):
+        profile_path = conf.get('Report', 'PROFILE')
+    return json_path, rate, profile_path
+
+QUAL_INSERT = '''INSERT INTO sequence (name, n_count, untrimmed_len, 
+    seq_trimmed, trimmed_len, record) 
+    VALUES (%s,%s,%s,%s,%s,%s)'''
+
+LINKER_INSERT = '''INSERT INTO sequence (name, mid, mid_seq, mid_match, 
+    mid_method, linker, linker_seq, linker_match, linker_method, cluster, 
+    concat_seq, concat_match, concat_method, n_count, untrimmed_len, 
+    seq_trimmed, trimmed_len, reject_reason, record) 
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)'''
+
+RECORD_INSERT = '''INSERT INTO sequence_record (id, record) VALUES (%s,%s)'''
+
+# secondary indexes on the sequence table, as (name, column)
+INDEXES = {LINKER_INSERT:[('sequence_cluster', 'cluster'), ('sequence_name', 
+    'name')], QUAL_INSERT:[('sequence_name', 'name')]}
+
+def splitInsert(sql):
+    '''The INSERTs for the split schema, from QUAL_INSERT or LINKER_INSERT:  
+    one for sequence, with an explicit id and without the record, and 
+    RECORD_INSERT'''
+    columns = ['id'] + [c.strip() for c in re.search('\((.*?)\)', sql, 
+        re.S).group(1).split(',')][:-1]
+    return 'INSERT INTO sequence (%s) VALUES (%s)' % (', '.join(columns), 
+        ','.join(['%s'] * len(columns))), RECORD_INSERT
+
+def qualOnlyWorker(record, qual, trimmed=None):
+    '''Quality trim a record, returning the row to be inserted by the 
+    writer (see QUAL_INSERT).  trimmed is the (trimmed record, N_count) from
+    qualTrimRecords, if the batch has already been trimmed'''
     # convert low-scoring bases to 'N'
     untrimmed_len = len(record.seq)
-    qual_trimmed = qualTrimming(record, qual)
-    N_count = str(qual_trimmed.seq).count('N')
+    if trimmed:
+        qual_trimmed, N_count = trimmed
+    else:
+        qual_trimmed = qualTrimming(record, qual)
+        N_count = str(qual_trimmed.seq).count('N')
     record = qual_trimmed
-    # pickle the sequence record, so we can store it as a BLOB in MySQL, we
-    # can thus recurrect it as a sequence object when we need it next.
-    record_pickle = cPickle.dumps(record,1)
-    cur.execute('''INSERT INTO sequence (name, n_count, untrimmed_len, 
-        seq_trimmed, trimmed_len, record) 
-        VALUES (%s,%s,%s,%s,%s,%s)''', 
-        (record.id, N_count, untrimmed_len, record.seq, len(record.seq), 
-        record_pickle))
-    #pdb.set_trace()
-    cur.close()
-    conn.commit()
-    # keep our connection load low
-    conn.close()
-    return
-
-def linkerWorker(record, qual, tags, all_tags, all_tags_regex, reverse_mid, reverse_linkers, conf):
-    # we need a separate connection for each mysql cursor or they are going
-    # start going into locking hell and things will go poorly. Creating a new 
-    # connection for each worker process is the easiest/laziest solution.
-    # Connection pooling (DB-API) didn't work so hot, but probably because 
-    # I'm slightly retarded.
-    conn = MySQLdb.connect(user=conf.get('Database','USER'), 
-        passwd=conf.get('Database','PASSWORD'), 
-        db=conf.get('Database','DATABASE'))
-    cur = conn.cursor()
+    # encode the sequence record, so we can store it as a BLOB in MySQL, we
+    # can thus recurrect it as a sequence object (decodeRecord) when we need 
+    # it next.
+    record_blob = encodeRecord(record)
+    return (record.id, N_count, untrimmed_len, str(record.seq), 
+        len(record.seq), record_blob)
+
+class Assignment(object):
+    '''What tagRead found in one read - the fields of a sequence table row 
+    (see LINKER_INSERT), with the trimmed read itself (record) and, when the
+    read is a Read, where it sits in the untrimmed read (start, stop)'''
+    __slots__ = ('name', 'mid', 'mid_seq', 'mid_match', 'mid_method', 
+        'linker', 'linker_seq', 'linker_match', 'linker_method', 'cluster', 
+        'concat_seq', 'concat_match', 'concat_method', 'n_count', 
+        'untrimmed_len', 'reject_reason', 'record', 'start', 'stop')
+    
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+    
+    def __repr__(self):
+        return 'Assignment(%r, cluster=%r, mid=%r, linker=%r)' % (self.name, 
+            self.cluster, self.mid, self.linker)
+    
+    def row(self):
+        '''The sequence table row, less the record BLOB'''
+        return (self.name, self.mid, self.mid_seq, self.mid_match, 
+            self.mid_method, self.linker, self.linker_seq, self.linker_match, 
+            self.linker_method, self.cluster, self.concat_seq, 
+            self.concat_match, self.concat_method, self.n_count, 
+            self.untrimmed_len, str(self.record.seq), len(self.record.seq), 
+            self.reject_reason)
+
+def linkerWorker(record, qual, index, trimmed=None, concat_check=True, 
+hits=None, rejected=None):
+    '''Tag a record (see tagRead), returning the row to be inserted by the 
+    writer (see LINKER_INSERT)'''
+    tagged = tagRead(record, qual, index, trimmed, concat_check, hits, 
+        rejected)
+    # encode the sequence record, so we can store it as a BLOB in MySQL, we
+    # can thus recurrect it as a sequence object (decodeRecord) when we need 
+    # it next.
+    begin = time.time()
+    record_blob = encodeRecord(tagged.record)
+    STATS.time('encodeRecord', time.time() - begin)
+    return tagged.row() + (record_blob,)
+
+def tagRead(record, qual, index, trimmed=None, concat_check=True, hits=None,
+rejected=None):
+    '''Quality trim a record and find/trim its MID and linker, returning an
+    Assignment.  trimmed is the (trimmed record, N_count) from 
+    qualTrimRecords, if the batch has already been trimmed, and hits the 
+    (MID, left, right) matches from batchMatch, if the batch has already been
+    matched.  With concat_check, the trimmed read is screened for 
+    concatemers.  A read rejected by the ReadFilter skips the search, and the
+    reason goes in reject_reason'''
+    read = record
     # convert low-scoring bases to 'N'
     untrimmed_len = len(record.seq)
-    qual_trimmed = qualTrimming(record, qual)
-    N_count = str(qual_trimmed.seq).count('N')
+    if trimmed:
+        qual_trimmed, N_count = trimmed
+    else:
+        qual_trimmed = qualTrimming(record, qual)
+        N_count = str(qual_trimmed.seq).count('N')
     # search on 5' (left) end for MID
-    mid = midTrim(qual_trimmed, tags, fuzzy=True)
+    if rejected:
+        STATS.count('rejected')
+        STATS.count('rejected %s' % rejected)
+        mid = None
+    else:
+        begin = time.time()
+        if hits:
+            mid = midTrim(qual_trimmed, index.mids, fuzzy=True, hit=hits[0])
+        else:
+            mid = midTrim(qual_trimmed, index.mids, fuzzy=True)
+        STATS.time('midTrim', time.time() - begin)
     #TODO:  Add length parameters
     if mid:
         # if MID, search for exact matches (for and revcomp) on Linker
         # provided no exact matches, use fuzzy matching (Smith-Waterman) +
         # error correction to find Linker
         mid, trimmed, seq_match, m_type = mid
-        linker = linkerTrim(trimmed, tags[mid], fuzzy=True)
+        begin = time.time()
+        if hits:
+            linker = linkerTrim(trimmed, index.linkers[mid], fuzzy=True, 
+                left=hits[1], right=hits[2])
+        else:
+            linker = linkerTrim(trimmed, index.linkers[mid], fuzzy=True)
+        STATS.time('linkerTrim', time.time() - begin)
         if linker:
             l_tag, l_trimmed, l_seq_match, l_critter, l_m_type = linker
+            if l_m_type == 'tag-mismatch':
+                STATS.count('tag-mismatch')
         else:
+            STATS.count('no linker')
             l_tag, l_trimmed, l_seq_match, l_critter, l_m_type, concat_type, \
             concat_count = (None,) * 7
     else:
-        mid, trimmed, seq_match, m_type = (None,) * 4
+        if not rejected:
+            STATS.count('no MID')
+        mid, trimmed, seq_match, m_type = None, None, None, None
         l_tag, l_trimmed, l_seq_match, l_critter, l_m_type, concat_type, \
         concat_count = (None,) * 7
     # check for concatemers
-    concat_check = False
     if concat_check:
         if l_trimmed and len(l_trimmed.seq) > 0:
+            begin = time.time()
             concat_tag, concat_type, concat_seq_match = concatCheck(l_trimmed, 
-                all_tags, all_tags_regex, reverse_linkers, fuzzy=True)
+                index.concat, fuzzy=True)
+            STATS.time('concatCheck', time.time() - begin)
+            if concat_type:
+                STATS.count(concat_type)
         else:
             concat_tag, concat_type, concat_seq_match = None, None, None
     else:
@@ -413,24 +1761,576 @@ def linkerWorker(record, qual, tags, all_tags, all_tags_regex, reverse_mid, reve
     # if we are able to trim the MID
     elif trimmed:
         record = trimmed
-    # pickle the sequence record, so we can store it as a BLOB in MySQL, we
-    # can thus recurrect it as a sequence object when we need it next.
-    record_pickle = cPickle.dumps(record,1)
-    cur.execute('''INSERT INTO sequence (name, mid, mid_seq, mid_match, 
-        mid_method, linker, linker_seq, linker_match, linker_method, cluster, 
-        concat_seq, concat_match, concat_method, n_count, untrimmed_len, 
-        seq_trimmed, trimmed_len, record) 
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)''', 
-        (record.id, reverse_mid[mid], mid, seq_match, m_type, 
-        reverse_linkers[l_tag], l_tag, l_seq_match, l_m_type, l_critter, 
-        concat_tag, concat_seq_match, concat_type, N_count, untrimmed_len,
-        record.seq, len(record.seq), record_pickle))
-    #pdb.set_trace()
+    if isinstance(record, Read) and isinstance(read, Read):
+        start, stop = record.start - read.start, record.stop - read.start
+    else:
+        start = stop = None
+    return Assignment(name=record.id, mid=index.reverse_mid[mid], mid_seq=mid,
+        mid_match=seq_match, mid_method=m_type, 
+        linker=index.reverse_linkers[l_tag], linker_seq=l_tag, 
+        linker_match=l_seq_match, linker_method=l_m_type, cluster=l_critter, 
+        concat_seq=concat_tag, concat_match=concat_seq_match, 
+        concat_method=concat_type, n_count=N_count, 
+        untrimmed_len=untrimmed_len, reject_reason=rejected, record=record, 
+        start=start, stop=stop)
+
+class BatchWriter(object):
+    '''Base output sink.  Rows are buffered and handed to send() in batches of
+    batch_size, and we only commit every commit_interval rows (and on close),
+    so we are not paying for a round trip + fsync on every read.  When 
+    tracking an input (see track()), a checkpoint goes in with every commit.
+    Subclasses provide send(batch), checkpoint(input, stored, complete), 
+    commit() and release()'''
+    def __init__(self, batch_size=500, commit_interval=5000):
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.batch = []
+        self.uncommitted = 0
+        self.rows = 0
+        self.commits = 0
+        self.input = None
+        self.stored = 0
+        # per-batch latency (send + any commit it triggers), in sec.
+        self.latency = []
+    
+    def splitSchema(self, sql, cur):
+        '''Write to the split schema - sequence rows are numbered here (we 
+        are the only writer), so each record can go in under its row's id'''
+        self.sql, self.record_sql = splitInsert(sql)
+        cur.execute('''SELECT MAX(id) FROM sequence''')
+        self.next_id = (cur.fetchone()[0] or 0) + 1
+    
+    def splitRows(self, batch):
+        '''Number a batch of rows for the split schema, returning the 
+        sequence rows (without their records) and the (id, record) rows'''
+        ids = range(self.next_id, self.next_id + len(batch))
+        self.next_id += len(batch)
+        return [(i,) + row[:-1] for i, row in zip(ids, batch)], \
+            [(i, row[-1]) for i, row in zip(ids, batch)]
+    
+    def track(self, input, stored=0):
+        '''Checkpoint progress through input (a path), of which stored reads
+        were written by earlier runs'''
+        self.input, self.stored = input, stored
+    
+    def write(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+    
+    def flush(self, commit=False):
+        if not self.batch and not (commit and self.uncommitted):
+            return
+        start = time.time()
+        if self.batch:
+            self.send(self.batch)
+            self.uncommitted += len(self.batch)
+            self.rows += len(self.batch)
+            self.batch = []
+        if self.uncommitted and (commit or self.uncommitted >= 
+        self.commit_interval):
+            if self.input:
+                self.checkpoint(self.input, self.stored + self.rows, False)
+            self.commit()
+            self.commits += 1
+            self.uncommitted = 0
+        self.latency.append(time.time() - start)
+    
+    def stats(self):
+        '''Summary of what we wrote, and how long the batches took'''
+        l = numpy.array(self.latency or [0.])
+        return {'sink':self.__class__.__name__, 'rows':self.rows, 
+            'batches':len(self.latency), 'commits':self.commits, 
+            'total':l.sum(), 'mean':l.mean(), 'median':numpy.median(l), 
+            'max':l.max()}
+    
+    def close(self):
+        self.flush(commit=True)
+        if self.input:
+            # the whole input is stored
+            self.checkpoint(self.input, self.stored + self.rows, True)
+            self.commit()
+        self.release()
+        return self.stats()
+
+CHECKPOINT_MYSQL = '''INSERT INTO checkpoint (input, stored, complete) VALUES 
+    (%s,%s,%s) ON DUPLICATE KEY UPDATE stored = VALUES(stored), complete = 
+    VALUES(complete)'''
+
+CHECKPOINT_SQLITE = '''INSERT OR REPLACE INTO checkpoint (input, stored, 
+    complete, updated) VALUES (?,?,?,datetime('now'))'''
+
+class MySQLWriter(BatchWriter):
+    '''Write rows to MySQL over a single, persistent connection, with 
+    executemany().  With split, records go in sequence_record (see 
+    createSeqTable).  With bulk, the session is set up for loading'''
+    def __init__(self, conf, sql, batch_size=500, commit_interval=5000,
+    split=False, bulk=False):
+        BatchWriter.__init__(self, batch_size, commit_interval)
+        self.sql, self.record_sql = sql, None
+        self.conn = outputConnection(conf)
+        self.cur = self.conn.cursor()
+        if split:
+            self.splitSchema(sql, self.cur)
+        if bulk:
+            # ids are ours and there are no foreign keys, so InnoDB can skip
+            # the uniqueness and foreign key checks on secondary indexes
+            self.cur.execute('''SET SESSION unique_checks = 0, 
+                foreign_key_checks = 0''')
+    
+    def send(self, batch):
+        if self.record_sql:
+            rows, records = self.splitRows(batch)
+            self.cur.executemany(self.sql, rows)
+            self.cur.executemany(self.record_sql, records)
+        else:
+            self.cur.executemany(self.sql, batch)
+    
+    def checkpoint(self, input, stored, complete):
+        self.cur.execute(CHECKPOINT_MYSQL, (input, stored, complete))
+    
+    def commit(self):
+        self.conn.commit()
+    
+    def release(self):
+        self.cur.close()
+        self.conn.close()
+
+class SQLiteWriter(BatchWriter):
+    '''Write rows to a local SQLite database (in WAL mode), one transaction 
+    per commit_interval rows.  The record (last) column goes in as a BLOB - 
+    in sequence_record, with split'''
+    def __init__(self, path, sql, batch_size=500, commit_interval=5000,
+    split=False):
+        BatchWriter.__init__(self, batch_size, commit_interval)
+        self.sql, self.record_sql = sql, None
+        self.conn = sqliteConnect(path)
+        self.cur = self.conn.cursor()
+        if split:
+            self.splitSchema(sql, self.cur)
+        # sqlite3 uses qmark-style parameters
+        self.sql = self.sql.replace('%s', '?')
+        if self.record_sql:
+            self.record_sql = self.record_sql.replace('%s', '?')
+    
+    def send(self, batch):
+        if self.record_sql:
+            rows, records = self.splitRows(batch)
+            self.cur.executemany(self.sql, rows)
+            self.cur.executemany(self.record_sql, [(i, sqlite3.Binary(r)) for 
+                i, r in records])
+        else:
+            self.cur.executemany(self.sql, [row[:-1] + 
+                (sqlite3.Binary(row[-1]),) for row in batch])
+    
+    def checkpoint(self, input, stored, complete):
+        self.cur.execute(CHECKPOINT_SQLITE, (input, stored, complete))
+    
+    def commit(self):
+        self.conn.commit()
+    
+    def release(self):
+        self.cur.close()
+        self.conn.close()
+
+class ClusterFileWriter(BatchWriter):
+    '''Stream reads straight into buffered, per-cluster FASTA and QUAL files 
+    (e.g. bird1.fna/bird1.qual) in directory, skipping the database.  Reads 
+    without a cluster go to unassigned.fna/.qual.  The read written is the 
+    trimmed one, decoded from the record (last) column.  With keep, we 
+    append to existing files.  Every file is listed in directory/manifest 
+    before it is first written, and checkpoints go in directory/checkpoint, 
+    with the size of every cluster file as of the checkpoint (see 
+    restoreClusterFiles)'''
+    def __init__(self, directory, sql, batch_size=500, commit_interval=5000,
+    buffering=65536, keep=False):
+        BatchWriter.__init__(self, batch_size, commit_interval)
+        self.directory = directory
+        self.buffering = buffering
+        self.mode = keep and 'a' or 'w'
+        # position of the cluster column in a row
+        if sql == LINKER_INSERT:
+            self.cluster = 9
+        else:
+            self.cluster = None
+        self.handles = {}
+        self.checkpoints = fileCheckpoints(directory)
+        self.offsets = fileOffsets(directory) or {}
+        self.manifest = clusterManifest(directory)
+    
+    def _handles(self, cluster):
+        if cluster not in self.handles:
+            name = os.path.join(self.directory, cluster.replace(os.sep, '_'))
+            self._list([os.path.basename(name) + ext for ext in ('.fna', 
+                '.qual')])
+            self.handles[cluster] = (open(name + '.fna', self.mode, 
+                self.buffering), open(name + '.qual', self.mode, 
+                self.buffering))
+        return self.handles[cluster]
+    
+    def _list(self, names):
+        # on disk before the files are, so we only ever clear out our own
+        names = [n for n in names if n not in self.manifest]
+        if names:
+            handle = open(os.path.join(self.directory, 'manifest'), 'a')
+            handle.write(''.join(['%s\n' % n for n in names]))
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.close()
+            self.manifest.update(names)
+    
+    def send(self, batch):
+        for row in batch:
+            if self.cluster is not None and row[self.cluster]:
+                cluster = row[self.cluster]
+            else:
+                cluster = 'unassigned'
+            record = decodeRecord(row[-1])
+            fasta, qual = self._handles(cluster)
+            fasta.write('>%s\n%s\n' % (record.description or record.id, 
+                record.seq))
+            qual.write('>%s\n%s\n' % (record.description or record.id, 
+                ' '.join([str(q) for q in record.qual])))
+    
+    def checkpoint(self, input, stored, complete):
+        # written out by commit(), once the reads are on disk
+        self.checkpoints[input] = (stored, complete)
+    
+    def commit(self):
+        for handles in self.handles.values():
+            for handle in handles:
+                handle.flush()
+                os.fsync(handle.fileno())
+                self.offsets[os.path.basename(handle.name)] = os.fstat(
+                    handle.fileno()).st_size
+        if self.input:
+            path = os.path.join(self.directory, 'checkpoint')
+            handle = open(path + '.tmp', 'w')
+            for input, (stored, complete) in sorted(self.checkpoints.items()):
+                handle.write('%s\t%s\t%d\t%s\n' % (input, stored, complete, 
+                    time.strftime('%Y-%m-%d %H:%M:%S')))
+            for name, size in sorted(self.offsets.items()):
+                handle.write('#%s\t%s\n' % (name, size))
+            handle.close()
+            os.rename(path + '.tmp', path)
+    
+    def release(self):
+        for fasta, qual in self.handles.values():
+            fasta.close()
+            qual.close()
+
+def fileCheckpoints(directory):
+    '''Read the checkpoints written by a ClusterFileWriter into a dictionary 
+    of input -> (stored, complete)'''
+    checkpoints = {}
+    path = os.path.join(directory, 'checkpoint')
+    if os.path.isfile(path):
+        for line in open(path):
+            if line.startswith('#'):
+                continue
+            input, stored, complete = line.rstrip('\n').split('\t')[:3]
+            checkpoints[input] = (int(stored), bool(int(complete)))
+    return checkpoints
+
+def fileOffsets(directory):
+    '''Read the cluster file sizes written with the last ClusterFileWriter 
+    checkpoint into a dictionary of file name -> bytes.  {} if there is no 
+    checkpoint, and None if it has no sizes (an older run)'''
+    path = os.path.join(directory, 'checkpoint')
+    if not os.path.isfile(path):
+        return {}
+    offsets = None
+    for line in open(path):
+        if line.startswith('#'):
+            name, size = line[1:].rstrip('\n').split('\t')
+            offsets = offsets or {}
+            offsets[name] = int(size)
+    return offsets
+
+def clusterManifest(directory):
+    '''The names of the cluster files a ClusterFileWriter has written in 
+    directory (a set)'''
+    path = os.path.join(directory, 'manifest')
+    if not os.path.isfile(path):
+        return set()
+    return set([line.rstrip('\n') for line in open(path) if line.strip()])
+
+def restoreClusterFiles(directory):
+    '''Cut the cluster files in directory back to the last checkpoint.  The 
+    .fna and .qual files are buffered separately, so after a crash either 
+    one may hold reads (or half a line) the other doesn't - and neither is 
+    counted as stored.  Files in the manifest that the checkpoint doesn't 
+    know of are removed'''
+    offsets = fileOffsets(directory)
+    if offsets is None:
+        return
+    for f in sorted(clusterManifest(directory)):
+        path = os.path.join(directory, f)
+        if not os.path.isfile(path):
+            continue
+        size = os.path.getsize(path)
+        if f not in offsets:
+            print 'Removing %s - it was written after the last checkpoint' % f
+            os.remove(path)
+        elif size > offsets[f]:
+            print 'Truncating %s to the last checkpoint (%s of %s bytes)' % (f,
+                offsets[f], size)
+            handle = open(path, 'r+b')
+            handle.truncate(offsets[f])
+            handle.close()
+
+def outputSink(conf):
+    '''The output sink from [Output] SINK - mysql (default), sqlite or files'''
+    if conf.has_option('Output', 'SINK'):
+        sink = conf.get('Output', 'SINK').lower()
+        if sink not in ('mysql', 'sqlite', 'files'):
+            raise ValueError('Unknown output SINK %s' % sink)
+        return sink
+    return 'mysql'
+
+def outputPath(conf, default):
+    '''The output path (SQLite database or directory) from [Output] PATH'''
+    if conf.has_option('Output', 'PATH'):
+        return conf.get('Output', 'PATH')
+    return default
+
+def outputConnection(conf):
+    '''Connect to the configured database (the mysql or sqlite sink)'''
+    if outputSink(conf) == 'sqlite':
+        return sqliteConnect(outputPath(conf, 'sequence.sqlite'))
+    # only the mysql sink needs MySQLdb - the library API (Demultiplexer)
+    # and the other sinks work without it
+    import MySQLdb
+    return MySQLdb.connect(user=conf.get('Database','USER'), 
+        passwd=conf.get('Database','PASSWORD'), 
+        db=conf.get('Database','DATABASE'))
+
+def writerSettings(conf):
+    '''Get the batch size and commit interval for the writer'''
+    batch_size, commit_interval = 500, 5000
+    if conf.has_option('Database', 'BATCH_SIZE'):
+        batch_size = conf.getint('Database', 'BATCH_SIZE')
+    if conf.has_option('Database', 'COMMIT_INTERVAL'):
+        commit_interval = conf.getint('Database', 'COMMIT_INTERVAL')
+    return batch_size, commit_interval
+
+def schemaSettings(conf):
+    '''Whether to use the split schema ([Database] SCHEMA = split, rather 
+    than inline) and to bulk load ([Database] BULK_LOAD) - build the 
+    secondary indexes after the load, with load-friendly session settings'''
+    split, bulk = False, False
+    if conf.has_option('Database', 'SCHEMA'):
+        schema = conf.get('Database', 'SCHEMA').lower()
+        if schema not in ('inline', 'split'):
+            raise ValueError('Unknown SCHEMA %s' % schema)
+        split = schema == 'split'
+    if conf.has_option('Database', 'BULK_LOAD'):
+        bulk = conf.getboolean('Database', 'BULK_LOAD')
+    return split, bulk
+
+def openWriter(conf, sql, keep=False):
+    '''Open the BatchWriter for the configured output sink.  With keep, 
+    existing output is added to rather than replaced'''
+    batch_size, commit_interval = writerSettings(conf)
+    split, bulk = schemaSettings(conf)
+    sink = outputSink(conf)
+    if sink == 'sqlite':
+        return SQLiteWriter(outputPath(conf, 'sequence.sqlite'), sql, 
+            batch_size, commit_interval, split)
+    elif sink == 'files':
+        return ClusterFileWriter(outputPath(conf, 'clusters'), sql, batch_size,
+            commit_interval, keep=keep)
+    return MySQLWriter(conf, sql, batch_size, commit_interval, split, bulk)
+
+def prepareOutput(conf, sql, keep=False):
+    '''Create the table(s) or directory for the configured output sink.  With
+    keep, existing tables (or files, cut back to the last checkpoint) and 
+    their checkpoints are kept - otherwise they are dropped, and for the 
+    files sink that means every cluster file an earlier run wrote to the 
+    directory (see clusterFiles)'''
+    sink = outputSink(conf)
+    if sink == 'files':
+        path = outputPath(conf, 'clusters')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        known = clusterFiles(conf, path)
+        if not keep:
+            for f in sorted(known) + ['checkpoint', 'manifest']:
+                if os.path.isfile(os.path.join(path, f)):
+                    os.remove(os.path.join(path, f))
+        else:
+            restoreClusterFiles(path)
+        return
+    if sink == 'sqlite':
+        create = {LINKER_INSERT:createSeqTableSQLite, 
+            QUAL_INSERT:createQualSeqTableSQLite}
+    else:
+        create = {LINKER_INSERT:createSeqTable, QUAL_INSERT:createQualSeqTable}
+    split, bulk = schemaSettings(conf)
+    conn = outputConnection(conf)
+    cur = conn.cursor()
+    create[sql](cur, keep, split, bulk)
+    conn.commit()
     cur.close()
+    conn.close()
+
+def clusterFiles(conf, directory):
+    '''The cluster files (.fna/.qual) in directory that earlier runs wrote - 
+    those in the manifest or the last checkpoint.  Exits if the input is in 
+    directory, or if it holds .fna/.qual files we didn't write, rather than 
+    risk clearing out (or appending to) someone else's reads'''
+    root = os.path.realpath(directory)
+    inside = [f for f in inputSettings(conf) if f is not None and 
+        os.path.realpath(f).startswith(root + os.sep)]
+    if inside:
+        print 'The input (%s) is in the output directory %s - choose another'\
+        ' [Output] PATH.' % (', '.join(inside), directory)
+        sys.exit(2)
+    known = clusterManifest(directory) | set(fileOffsets(directory) or {})
+    unknown = sorted([f for f in os.listdir(directory) if 
+        os.path.splitext(f)[1] in ('.fna', '.qual') and f not in known])
+    if unknown:
+        print '%s holds .fna/.qual files this program did not write (%s) - '\
+        'move them or choose another [Output] PATH.' % (directory, 
+        ', '.join(unknown[:5]) + (len(unknown) > 5 and ', ...' or ''))
+        sys.exit(2)
+    return known
+
+def finishOutput(conf, sql):
+    '''Build the secondary indexes on the sequence table, if they were put 
+    off for a bulk load.  Returns the time taken (or None)'''
+    split, bulk = schemaSettings(conf)
+    sink = outputSink(conf)
+    if not bulk or sink == 'files':
+        return None
+    start = time.time()
+    conn = outputConnection(conf)
+    cur = conn.cursor()
+    if sink == 'sqlite':
+        createIndexesSQLite(cur, INDEXES[sql])
+    else:
+        createIndexes(cur, INDEXES[sql])
     conn.commit()
-    # keep our connection load low
+    cur.close()
     conn.close()
-    return
+    return time.time() - start
+
+def storedNames(conf):
+    '''The names of the reads already in the configured output'''
+    if outputSink(conf) == 'files':
+        names = set()
+        directory = outputPath(conf, 'clusters')
+        for f in os.listdir(directory):
+            if f.endswith('.fna'):
+                for line in open(os.path.join(directory, f)):
+                    if line.startswith('>'):
+                        names.add(line[1:].split(None, 1)[0])
+        return names
+    conn = outputConnection(conf)
+    cur = conn.cursor()
+    cur.execute('''SELECT name FROM sequence''')
+    names = set([row[0] for row in cur.fetchall()])
+    cur.close()
+    conn.close()
+    return names
+
+def checkpoints(conf):
+    '''The checkpoints in the configured output, as a dictionary of input -> 
+    (stored, complete)'''
+    if outputSink(conf) == 'files':
+        return fileCheckpoints(outputPath(conf, 'clusters'))
+    conn = outputConnection(conf)
+    cur = conn.cursor()
+    cur.execute('''SELECT input, stored, complete FROM checkpoint''')
+    checkpoints = dict([(input, (stored, bool(complete))) for input, stored, 
+        complete in cur.fetchall()])
+    cur.close()
+    conn.close()
+    return checkpoints
+
+def storedCount(sequence, names, fastq=False):
+    '''How many of the reads in sequence (a FASTA, or FASTQ with fastq, 
+    path) are named in names (a set) - only the read names are parsed'''
+    if fastq:
+        ids = (record.id for record in fastqRecords(openInput(sequence)))
+    else:
+        ids = ((line[1:].split(None, 1) or [''])[0] for line in 
+            openInput(sequence) if line.startswith('>'))
+    count = 0
+    for id in ids:
+        if id in names:
+            count += 1
+    return count
+
+def skipStored(records, names):
+    '''Pass on only the records whose names are not in names'''
+    for record in records:
+        if record.id not in names:
+            yield record
+
+def writerWorker(conf, sql, row_queue, stats_queue, keep=False, track=None):
+    '''Dedicated writer process - takes lists of rows off row_queue and 
+    writes them with the configured BatchWriter until it gets None.  track is
+    the (input, stored) to checkpoint, if any.  Sends (True, statistics) - or
+    (False, traceback) if it fails - back on stats_queue'''
+    try:
+        writer = openWriter(conf, sql, keep)
+        if track:
+            writer.track(*track)
+        while True:
+            rows = row_queue.get()
+            if rows is None:
+                break
+            for row in rows:
+                writer.write(row)
+        stats = writer.close()
+    except Exception:
+        stats_queue.put((False, traceback.format_exc()))
+    else:
+        stats_queue.put((True, stats))
+
+def checkWriter(writer, stats_queue, block=False):
+    '''Return the statistics the writer process sent on stats_queue - or 
+    None, without block, if they haven't come in yet.  Raise if the writer 
+    failed or died'''
+    while True:
+        try:
+            ok, result = stats_queue.get(block, 1)
+        except Queue.Empty:
+            # an exited writer has flushed everything it put
+            if writer.exitcode is not None:
+                raise RuntimeError('The writer process died unexpectedly '\
+                    '(exit code %s)' % writer.exitcode)
+            if not block:
+                return None
+            continue
+        if not ok:
+            raise RuntimeError('Writer failed:\n%s' % result)
+        return result
+
+def writerPut(writer, row_queue, stats_queue, rows):
+    '''Put rows on row_queue for the writer process, checking on the writer
+    while the queue is full'''
+    while True:
+        try:
+            row_queue.put(rows, True, 1)
+            return
+        except Queue.Full:
+            checkWriter(writer, stats_queue)
+
+def drainQueue(queue, timeout=1):
+    '''Take everything off queue, until nothing has come in for timeout 
+    seconds'''
+    while True:
+        try:
+            queue.get(True, timeout)
+        except Queue.Empty:
+            return
+
+def writerReport(stats):
+    '''Print the writer statistics'''
+    print 'Writer (%(sink)s):  %(rows)s rows in %(batches)s batches, %(commits)s commits' % stats
+    print '    batch latency (sec):  mean = %(mean).4f, median = %(median).4f, max = %(max).4f, total = %(total).2f' % stats
 
 def motd():
     '''Startup info'''
@@ -457,6 +2357,18 @@ def interface():
     p.add_option('--configuration', '-c', dest = 'conf', action='store', \
 type='string', default = None, help='The path to the configuration file.', \
 metavar='FILE')
+    p.add_option('--migrate', dest = 'migrate', action='store_true', \
+default = False, help='Re-encode pickled records in an existing sequence table '\
+'and exit.')
+    p.add_option('--resume', dest = 'resume', action='store_true', \
+default = False, help='Keep the existing output and skip reads that are '\
+'already stored (e.g. after a crash).')
+    p.add_option('--append', dest = 'append', action='store_true', \
+default = False, help='Keep the existing output and add the reads from a new '\
+'input to it.')
+    p.add_option('--worker', dest = 'worker', action='store_true', \
+default = False, help='Work for the coordinator of a distributed run (see '\
+'[Distributed]) until it runs out of shards.')
 
     (options,arg) = p.parse_args()
     if not options.conf:
@@ -466,46 +2378,800 @@ metavar='FILE')
         print "You must provide a valid path to the configuration file."
         p.print_help()
         sys.exit(2)
+    if options.resume and options.append:
+        print "Use one of --resume or --append."
+        sys.exit(2)
     return options, arg
 
+class TagSet(object):
+    '''A group of tags that are searched for together (the MIDs, or the 
+    linkers used with one MID) and everything precomputed to match them:  one
+    compiled alternation per read end, the reverse complements and the 
+    1-error neighborhoods.  tags maps each tag to what it identifies (the 
+    linkers for a MID, the cluster for a linker).  With gaps, the 5' end 
+    pattern is anchored at the start of the read; otherwise it may be 
+    preceded by up to max_gap_char bases.  kind (MID or linker) labels the 
+    match counts in the run report.  With a cache_size, the end matches are 
+    memoized in an LRU cache per end (see cachedEnd).  Matches are counted 
+    per tag, and the fuzzy fallback tries the tags in order of matches so 
+    far (order, rev_order), re-ranked every reorder matches.  That order is 
+    for speed only - ties between equally good fuzzy hits go to the tag 
+    that comes first in tags (rank, and rev_rank for the reverse 
+    complements, so both ends agree), whatever this process has seen 
+    before'''
+    reorder = 1000
+    
+    def __init__(self, tags, max_gap_char=22, gaps=False, kind='linker', 
+    cache_size=0):
+        self.tags = tags
+        self.kind = kind
+        self.max_gap_char = max_gap_char
+        # reverse complement -> tag
+        self.revtags = revCompTags(dict([(tag, tag) for tag in tags]))
+        alternation = '|'.join(tags)
+        revalternation = '|'.join(self.revtags)
+        if gaps:
+            self.left_gap = self.right_gap = 0
+            self.left_regex = re.compile('^(%s)' % alternation)
+            self.right_regex = re.compile('(%s)$' % revalternation)
+        else:
+            self.left_gap = self.right_gap = max_gap_char
+            self.left_regex = re.compile('^[acgtnACGTN]{0,%s}(%s)' % 
+                (max_gap_char, alternation))
+            self.right_regex = re.compile('(%s)[acgtnACGTN]{0,%s}$' % 
+                (revalternation, max_gap_char))
+        self.neighborhood = Neighborhood(tags)
+        self.rev_neighborhood = Neighborhood(self.revtags)
+        self.hamming = HammingMatcher(self)
+        # the bases the regex and neighborhood look at, at each end
+        self.left_window = self.left_gap + max(self.neighborhood.lengths)
+        self.right_window = self.right_gap + max(self.rev_neighborhood.lengths)
+        if cache_size:
+            self.left_cache = LRUCache(cache_size)
+            self.right_cache = LRUCache(cache_size)
+        else:
+            self.left_cache = self.right_cache = None
+        self.hits = dict.fromkeys(tags, 0)
+        self.matched = 0
+        self.order = list(tags)
+        self.rev_order = [revComp(tag) for tag in self.order]
+        self.rank = dict([(tag, i) for i, tag in enumerate(tags)])
+        self.rev_rank = dict([(revComp(tag), i) for tag, i in 
+            self.rank.items()])
+    
+    def hit(self, tag):
+        '''Count a match to tag (not its reverse complement)'''
+        self.hits[tag] += 1
+        self.matched += 1
+        if self.matched % self.reorder == 0:
+            # sorted() is stable, so ties keep their current order
+            self.order = sorted(self.order, key=self.hits.get, reverse=True)
+            self.rev_order = [revComp(tag) for tag in self.order]
+
+class TagIndex(object):
+    '''All of the tag tables for a run, built once from the MID, Linker and
+    Clusters sections and then shared (as-is) with every worker:  the tag 
+    library (MID -> linker -> cluster), all possible tags for the concatemer
+    check, the reverse lookups from sequence to name, and a TagSet for the 
+    MIDs and for the linkers of each MID.  With hamming, processChunk 
+    matches the read ends of each chunk in one batch (see batchMatch).  
+    cache_size is the size of each TagSet's end match caches'''
+    def __init__(self, mids, linkers, clust, max_gap_char=22, hamming=True, 
+    cache_size=0):
+        self.hamming = hamming
+        self.tags = tagLibrary(mids, linkers, clust)
+        self.all_tags, self.all_tags_regex = allPossibleTags(mids, linkers, 
+            clust)
+        self.reverse_mid = reverse(mids.items())
+        self.reverse_linkers = reverse(linkers.items())
+        self.reverse_mid[None] = None
+        self.reverse_linkers[None] = None
+        self.mids = TagSet(self.tags, max_gap_char, gaps=True, kind='MID', 
+            cache_size=cache_size)
+        self.linkers = {}
+        for mid in self.tags:
+            self.linkers[mid] = TagSet(self.tags[mid], max_gap_char, 
+                cache_size=cache_size)
+        self.concat = ConcatScanner(self.all_tags)
+    
+    def report(self):
+        '''Report the tag variants that map to more than one tag'''
+        self.mids.neighborhood.report('MID')
+        for mid in sorted(self.linkers):
+            name = self.reverse_mid[mid]
+            self.linkers[mid].neighborhood.report('%s linkers' % name)
+            self.linkers[mid].rev_neighborhood.report(
+                '%s linkers (reverse complement)' % name)
+
+def tagIndex(conf):
+    '''Build the TagIndex from the configuration file'''
+    #TODO:  Add levenshtein distance script to automagically determine 
+    #distance
+    hamming, cache_size = True, 0
+    if conf.has_option('Steps', 'HAMMING'):
+        hamming = conf.getboolean('Steps', 'HAMMING')
+    if conf.has_option('Steps', 'MATCH_CACHE'):
+        cache_size = conf.getint('Steps', 'MATCH_CACHE')
+    return TagIndex(dict(conf.items('MID')), dict(conf.items('Linker')), 
+        conf.items('Clusters'), hamming=hamming, cache_size=cache_size)
+
+def chunks(records, size):
+    '''Group an iterator of records into lists of (at most) size records'''
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _countHits(tags, end, hits):
+    for hit in hits:
+        if hit:
+            STATS.count('%s %s %s' % (tags.kind, end, hit[1] == 'regex' and 
+                'regex' or 'hamming'))
+            tags.hit(hit[0])
+
+def batchMatch(trimmed, index):
+    '''Match the MIDs and then the linkers of a chunk of quality trimmed 
+    records (from qualTrimRecords) with the HammingMatchers of index.  Returns
+    (MID, left linker, right linker) per record, as midTrim/linkerTrim would
+    find them - MIDs the batch can't resolve go through leftLinker here (the
+    linker search depends on them), linker ends it can't resolve are None'''
+    seqs = [str(t[0].seq) for t in trimmed]
+    mids = index.mids.hamming.left(seqs)
+    _countHits(index.mids, 'left', mids)
+    for i, s in enumerate(seqs):
+        if not mids[i]:
+            mids[i] = leftLinker(s, index.mids, fuzzy=True)
+    # the linkers depend on the MID, so batch the reads by MID
+    groups = {}
+    for i, mid in enumerate(mids):
+        if mid:
+            groups.setdefault(mid[0], []).append(i)
+    left, right = [None] * len(seqs), [None] * len(seqs)
+    for mid, members in groups.iteritems():
+        tags = index.linkers[mid]
+        ends = [seqs[i][mids[i][3]:] for i in members]
+        l, r = tags.hamming.left(ends), tags.hamming.right(ends)
+        _countHits(tags, 'left', l)
+        _countHits(tags, 'right', r)
+        for i, a, b in zip(members, l, r):
+            left[i], right[i] = a, b
+    return zip(mids, left, right)
+
+def processChunk(chunk, qual, index=None, concat_check=True, screen=None,
+worker=linkerWorker):
+    '''Quality trim a chunk of records in one batch, then run each through 
+    worker (linkerWorker, or tagRead for Assignments) given a TagIndex, or 
+    qualOnlyWorker, returning the rows.  
+    Given a ReadFilter (screen), reads it rejects skip the MID and linker 
+    search.  If the index has hamming set, the read ends are matched in one 
+    batch first (see batchMatch)'''
+    STATS.count('reads', len(chunk))
+    begin = time.time()
+    trimmed = qualTrimRecords(chunk, qual)
+    STATS.time('qualTrimRecords', time.time() - begin)
+    if index:
+        rejected = [None] * len(chunk)
+        if screen:
+            begin = time.time()
+            trimmed, rejected = screen.screen(trimmed)
+            STATS.time('readFilter', time.time() - begin)
+        hits = [None] * len(chunk)
+        keep = [i for i, r in enumerate(rejected) if not r]
+        if index.hamming and keep:
+            begin = time.time()
+            for i, h in zip(keep, batchMatch([trimmed[i] for i in keep], 
+            index)):
+                hits[i] = h
+            STATS.time('batchMatch', time.time() - begin)
+        return [STATS.run(worker, r, qual, index, t, concat_check, h, x)
+            for r, t, h, x in zip(chunk, trimmed, hits, rejected)]
+    else:
+        return [STATS.run(qualOnlyWorker, r, qual, t) for r, t in zip(chunk, 
+            trimmed)]
+
+def concatSetting(conf):
+    '''Whether to screen for concatemers ([Steps] CONCATCHECK, default on)'''
+    if conf.has_option('Steps', 'CONCATCHECK'):
+        return conf.getboolean('Steps', 'CONCATCHECK')
+    return True
+
+class Demultiplexer(object):
+    '''Tag reads from your own code - no configuration file or database.  
+    mids and linkers map names to sequences and clusters maps (MID name, 
+    linker name) to the cluster:
+    
+        demux = Demultiplexer(mids, linkers, clusters)
+        for tagged in demux.process(reads):
+            print tagged.name, tagged.cluster, tagged.start, tagged.stop
+    
+    Reads may be Reads (as from inputRecords), SeqRecords with phred_quality
+    or (name, sequence, quality scores) tuples.  process() streams them 
+    through in chunks of chunksize, yielding an Assignment per read, in 
+    order.  processBatch() tags one chunk, for use inside your own worker 
+    processes.  min_score, concat_check and screen (a ReadFilter) are as for
+    processChunk, and max_gap_char, hamming and cache_size as for TagIndex.  
+    Counts and timers go to STATS, as for a run'''
+    def __init__(self, mids, linkers, clusters, min_score=10, 
+    concat_check=True, screen=None, max_gap_char=22, hamming=True, 
+    cache_size=0, chunksize=1000):
+        clust = [('%s,%s' % names, cluster) for names, cluster in 
+            clusters.items()]
+        self.index = TagIndex(mids, linkers, clust, max_gap_char, hamming, 
+            cache_size)
+        self.min_score = min_score
+        self.concat_check = concat_check
+        self.screen = screen
+        self.chunksize = chunksize
+    
+    def read(self, read):
+        '''Return read as a Read'''
+        if isinstance(read, Read):
+            return read
+        if isinstance(read, tuple):
+            name, seq, qual = read
+            return Read(name, seq, array.array('B', qual))
+        return readFromSeqRecord(read)
+    
+    def processBatch(self, reads):
+        '''Tag a list of reads, returning a list of Assignments'''
+        return processChunk([self.read(r) for r in reads], self.min_score, 
+            self.index, self.concat_check, self.screen, tagRead)
+    
+    def process(self, reads):
+        '''Tag an iterable of reads, yielding an Assignment per read'''
+        for chunk in chunks(reads, self.chunksize):
+            for tagged in self.processBatch(chunk):
+                yield tagged
+
+def readFilter(conf):
+    '''The ReadFilter from [Qual] MIN_LENGTH, MAX_N, WINDOW and WINDOW_SCORE 
+    (default MIN_SCORE), or None if none of them are set'''
+    settings = {}
+    for option, name, get in (('MIN_LENGTH', 'min_length', conf.getint), 
+    ('MAX_N', 'max_n', conf.getfloat), ('WINDOW', 'window', conf.getint), 
+    ('WINDOW_SCORE', 'window_score', conf.getint)):
+        if conf.has_option('Qual', option):
+            settings[name] = get('Qual', option)
+    if not settings:
+        return None
+    settings.setdefault('window_score', conf.getint('Qual', 'MIN_SCORE'))
+    return ReadFilter(**settings)
+
+def poolWorker(conf, index, work_queue, result_queue):
+    '''Long-lived worker process.  Pulls chunks of records from work_queue 
+    until it gets None (the poison pill), returning (chunk index, rows, 
+    STATS snapshot) on result_queue.  index is the TagIndex built by the 
+    parent - workers are forked, so it is inherited (copy-on-write) rather 
+    than rebuilt or pickled'''
+    qual = conf.getint('Qual', 'MIN_SCORE')
+    concat_check = concatSetting(conf)
+    screen = readFilter(conf)
+    # we are forked with the parent's counts - start from zero
+    STATS.snapshot()
+    while True:
+        job = work_queue.get()
+        if job is None:
+            break
+        number, chunk = job
+        try:
+            rows = processChunk(chunk, qual, index, concat_check, screen)
+        except Exception:
+            result_queue.put((number, traceback.format_exc(), None, False))
+        else:
+            result_queue.put((number, rows, STATS.snapshot(), True))
+
+def checkWorkers(workers, result_queue):
+    '''Raise if a worker process has died, or if they have all exited while
+    we are still waiting on results - unless their last results have come 
+    in on result_queue since we stopped waiting for them'''
+    codes = [w.exitcode for w in workers]
+    if [c for c in codes if c]:
+        raise RuntimeError('A worker process died unexpectedly')
+    # an exited worker has flushed everything it put, so one look is enough
+    if None not in codes and result_queue.empty():
+        raise RuntimeError('Worker processes exited before returning all '\
+            'results')
+
+def pool(records, conf, n_procs, chunksize=1000, index=None):
+    '''Run records through n_procs long-lived worker processes, in chunks of
+    chunksize records.  Chunks go out over a bounded queue (so we only read 
+    ahead as fast as the workers can keep up) and the results are yielded 
+    back in input order'''
+    work_queue = multiprocessing.Queue(2 * n_procs)
+    result_queue = multiprocessing.Queue()
+    workers = []
+    for i in xrange(n_procs):
+        p = multiprocessing.Process(target=poolWorker, args=(conf, index, 
+            work_queue, result_queue))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+    pending, sent, received = {}, 0, 0
+    def collect(block):
+        # wait for one result if block, then drain whatever else is waiting
+        while True:
+            try:
+                number, result, stats, ok = result_queue.get(block, 1)
+            except Queue.Empty:
+                if not block:
+                    return
+                checkWorkers(workers, result_queue)
+                continue
+            if not ok:
+                raise RuntimeError('Worker failed on chunk %s:\n%s' % (number, 
+                    result))
+            pending[number] = result
+            STATS.merge(stats)
+            block = False
+    try:
+        for chunk in chunks(records, chunksize):
+            # blocks when the queue is full, which is our backpressure
+            while True:
+                try:
+                    work_queue.put((sent, chunk), True, 1)
+                    break
+                except Queue.Full:
+                    collect(False)
+                    checkWorkers(workers, result_queue)
+            sent += 1
+            collect(False)
+            while received in pending:
+                yield pending.pop(received)
+                received += 1
+        for w in workers:
+            work_queue.put(None)
+        while received < sent:
+            while received not in pending:
+                collect(True)
+            yield pending.pop(received)
+            received += 1
+    finally:
+        for w in workers:
+            if w.is_alive() and received < sent:
+                w.terminate()
+            w.join()
+
+def shardWorker(conf, index, fasta, qual, work_queue, result_queue, 
+chunksize=1000, skip=None):
+    '''Long-lived worker process for sharded input.  Pulls (shard number, 
+    byte ranges) jobs from work_queue until it gets None, parses the shard 
+    itself and returns ((shard, chunk), rows, STATS snapshot) for each chunk 
+    of chunksize records on result_queue, then ((shard, chunk), None) to mark
+    the end of the shard.  Reads named in skip (a set) are passed over'''
+    qual_score = conf.getint('Qual', 'MIN_SCORE')
+    concat_check = concatSetting(conf)
+    screen = readFilter(conf)
+    STATS.snapshot()
+    while True:
+        job = work_queue.get()
+        if job is None:
+            break
+        number, shard = job
+        chunk_number = 0
+        try:
+            records = shardRecords(fasta, qual, shard)
+            if skip:
+                records = skipStored(records, skip)
+            for chunk in chunks(records, chunksize):
+                rows = processChunk(chunk, qual_score, index, concat_check,
+                    screen)
+                result_queue.put(((number, chunk_number), rows, 
+                    STATS.snapshot(), True))
+                chunk_number += 1
+        except Exception:
+            result_queue.put(((number, chunk_number), traceback.format_exc(), 
+                None, False))
+        else:
+            result_queue.put(((number, chunk_number), None, None, True))
+
+def shardPool(fasta, qual, conf, n_procs, n_shards, chunksize=1000, 
+index=None, skip=None):
+    '''Run a FASTA + QUAL file pair (paths) through n_procs worker processes,
+    each of which memory-maps the files and parses its own shards (see 
+    shardRanges), so the parent never parses the input.  Rows are yielded 
+    back in input order - shard by shard, chunk by chunk - whatever order 
+    the workers finish in.  Shards are handed out in order, and shard 
+    i + 2 * n_procs only once shard i has been yielded, so however slow the
+    consumer is, only the rows of the 2 * n_procs shards in flight are ever
+    held (by us or in the workers' queues)'''
+    shards = shardRanges(fasta, qual, n_shards)
+    work_queue = multiprocessing.Queue()
+    queued = [0]
+    def feed():
+        # hand out the next shard or, once they are all out, the poison pills
+        if queued[0] < len(shards):
+            work_queue.put((queued[0], shards[queued[0]]))
+        elif queued[0] == len(shards):
+            for i in xrange(n_procs):
+                work_queue.put(None)
+        queued[0] += 1
+    for i in xrange(2 * n_procs):
+        feed()
+    result_queue = multiprocessing.Queue()
+    workers = []
+    for i in xrange(n_procs):
+        p = multiprocessing.Process(target=shardWorker, args=(conf, index, 
+            fasta, qual, work_queue, result_queue, chunksize, skip))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+    pending, shard, chunk = {}, 0, 0
+    try:
+        while shard < len(shards):
+            while (shard, chunk) not in pending:
+                try:
+                    key, result, stats, ok = result_queue.get(True, 1)
+                except Queue.Empty:
+                    checkWorkers(workers, result_queue)
+                    continue
+                if not ok:
+                    raise RuntimeError('Worker failed on shard %s:\n%s' % \
+                        (key[0], result))
+                pending[key] = result
+                if stats:
+                    STATS.merge(stats)
+            rows = pending.pop((shard, chunk))
+            if rows is None:
+                shard, chunk = shard + 1, 0
+                feed()
+            else:
+                chunk += 1
+                yield rows
+    finally:
+        for w in workers:
+            if w.is_alive() and shard < len(shards):
+                w.terminate()
+            w.join()
+
+def shardSettings(conf, n_procs):
+    '''Whether to shard the input ([Multiprocessing] SHARDING, default off)
+    and into how many shards ([Multiprocessing] SHARDS, default 4 per 
+    process)'''
+    sharding, n_shards = False, 4 * n_procs
+    if conf.has_option('Multiprocessing', 'SHARDING'):
+        sharding = conf.getboolean('Multiprocessing', 'SHARDING')
+    if conf.has_option('Multiprocessing', 'SHARDS'):
+        n_shards = conf.getint('Multiprocessing', 'SHARDS')
+    return sharding, n_shards
+
+class ShardLeases(object):
+    '''The coordinator's side of a distributed run (see coordinate).  The 
+    shards of a FASTA + QUAL file pair (from shardRanges) are leased to 
+    workers, which renew their lease as they go.  A lease that isn't renewed
+    within timeout seconds (the worker died, or its host did) goes back in 
+    the queue for the next worker to ask.  Finished shards are held until 
+    results() can hand them over in input order, so shard i + 2 * (workers 
+    seen) is only leased once shard i has been handed over - a slow output 
+    holds the workers up rather than filling our memory with rows.  Workers
+    call lease, renew, complete and fail over the network (see 
+    CoordinatorManager), each from its own server thread'''
+    def __init__(self, fasta, qual, shards, timeout=60):
+        self.fasta, self.qual = fasta, qual
+        self.shards = shards
+        self.timeout = timeout
+        self.queue = range(len(shards))
+        # shard -> (worker, lease expiry)
+        self.leases = {}
+        # shard -> (rows, STATS snapshot), until results() takes it
+        self.done = {}
+        self.next = 0
+        self.failed = None
+        self.workers = set()
+        self.lock = threading.Lock()
+    
+    def _expire(self):
+        now = time.time()
+        for number, (worker, expiry) in self.leases.items():
+            if expiry < now:
+                print 'Lease on shard %s (%s) expired - re-leasing' % (number, 
+                    worker)
+                STATS.count('shards re-leased')
+                del self.leases[number]
+                self.queue.append(number)
+                self.queue.sort()
+    
+    def _read(self, path, start, stop):
+        handle = open(path, 'rb')
+        try:
+            handle.seek(start)
+            return handle.read(stop - start)
+        finally:
+            handle.close()
+    
+    def lease(self, worker):
+        '''Lease the next shard to worker.  Returns (shard number, FASTA 
+        text, QUAL text), 'wait' if every shard left is leased to someone 
+        else (and so might yet come back) or too far ahead of the output, or
+        None when there is nothing left to do'''
+        self.lock.acquire()
+        try:
+            self.workers.add(worker)
+            self._expire()
+            if self.failed or not (self.queue or self.leases):
+                return None
+            if not self.queue or self.queue[0] >= self.next + 2 * \
+            len(self.workers):
+                return 'wait'
+            number = self.queue.pop(0)
+            self.leases[number] = (worker, time.time() + self.timeout)
+        finally:
+            self.lock.release()
+        fasta_start, fasta_stop, qual_start, qual_stop = self.shards[number]
+        return number, self._read(self.fasta, fasta_start, fasta_stop), \
+            self._read(self.qual, qual_start, qual_stop)
+    
+    def renew(self, worker, number):
+        '''Extend worker's lease on shard number, taking it back if the 
+        lease expired but nobody else has it yet.  False if the shard has 
+        gone to another worker (or is done), in which case worker should 
+        drop it'''
+        self.lock.acquire()
+        try:
+            lease = self.leases.get(number)
+            if lease and lease[0] != worker or number < self.next or \
+            number in self.done:
+                return False
+            if number in self.queue:
+                self.queue.remove(number)
+            self.leases[number] = (worker, time.time() + self.timeout)
+            return True
+        finally:
+            self.lock.release()
+    
+    def complete(self, worker, number, rows, snapshot):
+        '''Hand in the rows (and STATS snapshot) for shard number.  The 
+        first worker to finish a shard wins, whoever holds the lease - 
+        returns False if worker was too late'''
+        self.lock.acquire()
+        try:
+            if number < self.next or number in self.done:
+                return False
+            self.leases.pop(number, None)
+            if number in self.queue:
+                self.queue.remove(number)
+            self.done[number] = (rows, snapshot)
+            return True
+        finally:
+            self.lock.release()
+    
+    def fail(self, worker, number, error):
+        '''Stop the run - worker raised error (a traceback) on shard 
+        number, which would only fail again elsewhere'''
+        self.lock.acquire()
+        try:
+            self.failed = (worker, number, error)
+        finally:
+            self.lock.release()
+    
+    def results(self):
+        '''Yield the rows of each shard, in input order, as they come in'''
+        while self.next < len(self.shards):
+            self.lock.acquire()
+            try:
+                self._expire()
+                result = self.done.pop(self.next, None)
+                failed = self.failed
+            finally:
+                self.lock.release()
+            if failed:
+                raise RuntimeError('Worker %s failed on shard %s:\n%s' % 
+                    failed)
+            if result is None:
+                time.sleep(0.1)
+                continue
+            rows, snapshot = result
+            STATS.merge(snapshot)
+            self.next += 1
+            yield rows
+
+class CoordinatorManager(multiprocessing.managers.BaseManager):
+    '''Serves the ShardLeases of a distributed run to workers over TCP'''
+    pass
+
+def distributedSettings(conf):
+    '''[Distributed] settings:  whether this is a distributed run 
+    (DISTRIBUTED, default off), the coordinator's (ADDRESS, PORT), AUTHKEY 
+    (no default - main refuses to run without one), the lease TIMEOUT 
+    (default 60 sec.), the number of SHARDS (default 64) and of 
+    LOCAL_WORKERS to start on this host (default 0)'''
+    distributed, host, port, authkey = False, '127.0.0.1', 50000, ''
+    timeout, n_shards, local = 60, 64, 0
+    if conf.has_option('Distributed', 'DISTRIBUTED'):
+        distributed = conf.getboolean('Distributed', 'DISTRIBUTED')
+    if conf.has_option('Distributed', 'ADDRESS'):
+        host = conf.get('Distributed', 'ADDRESS')
+    if conf.has_option('Distributed', 'PORT'):
+        port = conf.getint('Distributed', 'PORT')
+    if conf.has_option('Distributed', 'AUTHKEY'):
+        authkey = conf.get('Distributed', 'AUTHKEY')
+    if conf.has_option('Distributed', 'TIMEOUT'):
+        timeout = conf.getfloat('Distributed', 'TIMEOUT')
+    if conf.has_option('Distributed', 'SHARDS'):
+        n_shards = conf.getint('Distributed', 'SHARDS')
+    if conf.has_option('Distributed', 'LOCAL_WORKERS'):
+        local = conf.getint('Distributed', 'LOCAL_WORKERS')
+    return distributed, (host, port), authkey, timeout, n_shards, local
+
+def distributedWorker(conf, address, authkey, name=None):
+    '''Worker for a distributed run (linkers.py --worker).  Connects to the 
+    coordinator at address and processes the shards it leases out until 
+    there are none left, renewing the lease after every chunk.  The shards 
+    arrive as text, so the worker needs neither the input files nor the 
+    database - just the configuration file'''
+    if name is None:
+        name = '%s:%s' % (socket.gethostname(), os.getpid())
+    qual = conf.getint('Qual', 'MIN_SCORE')
+    index = None
+    if conf.getboolean('Steps', 'LINKERTRIM'):
+        index = tagIndex(conf)
+    concat_check = concatSetting(conf)
+    screen = readFilter(conf)
+    if conf.has_option('Multiprocessing', 'CHUNKSIZE'):
+        chunksize = conf.getint('Multiprocessing', 'CHUNKSIZE')
+    else:
+        chunksize = 1000
+    CoordinatorManager.register('leases')
+    manager = CoordinatorManager(address, authkey)
+    manager.connect()
+    leases = manager.leases()
+    STATS.snapshot()
+    while True:
+        job = leases.lease(name)
+        if job is None:
+            break
+        if job == 'wait':
+            time.sleep(1)
+            continue
+        number, fasta, qual_text = job
+        rows = []
+        try:
+            for chunk in chunks(pairedFastaQual(cStringIO.StringIO(fasta), 
+            cStringIO.StringIO(qual_text)), chunksize):
+                rows.extend(processChunk(chunk, qual, index, concat_check, 
+                    screen))
+                if not leases.renew(name, number):
+                    break
+            else:
+                leases.complete(name, number, rows, STATS.snapshot())
+                continue
+        except Exception:
+            leases.fail(name, number, traceback.format_exc())
+            raise
+        # someone else has the shard - drop it
+        STATS.snapshot()
+
+def coordinate(conf, fasta, qual, address, authkey, timeout=60, n_shards=64,
+local=0, skip=None):
+    '''Coordinate a distributed run over a FASTA + QUAL file pair (paths):  
+    serve ShardLeases on address, start local workers (if any) and yield the
+    rows of each shard, in input order, leaving out reads named in skip (a 
+    set)'''
+    leases = ShardLeases(fasta, qual, shardRanges(fasta, qual, n_shards), 
+        timeout)
+    CoordinatorManager.register('leases', callable=lambda: leases, 
+        exposed=('lease', 'renew', 'complete', 'fail'))
+    server = CoordinatorManager(address, authkey).get_server()
+    # the server thread can't be stopped - it goes when we do
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print 'Coordinating %s shards on %s:%s' % ((len(leases.shards),) + 
+        tuple(server.address))
+    workers = []
+    host = address[0] not in ('', '0.0.0.0') and address[0] or '127.0.0.1'
+    for i in xrange(local):
+        p = multiprocessing.Process(target=distributedWorker, args=(conf, 
+            (host, server.address[1]), authkey))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+    try:
+        for rows in leases.results():
+            if skip:
+                rows = [row for row in rows if row[0] not in skip]
+            yield rows
+    finally:
+        for w in workers:
+            if w.is_alive() and leases.next < len(leases.shards):
+                w.terminate()
+            w.join()
+
 def main():
     '''Main loop'''
+    import progress
     start_time = time.time()
     options, arg = interface()
     motd()
     print 'Started: ', time.strftime("%a %b %d, %Y  %H:%M:%S", time.localtime(start_time))
     conf = ConfigParser.ConfigParser()
     conf.read(options.conf)
-    conn = MySQLdb.connect(user=conf.get('Database','USER'), 
-        passwd=conf.get('Database','PASSWORD'), 
-        db=conf.get('Database','DATABASE'))
-    cur = conn.cursor()
+    if options.migrate:
+        print 'Re-encoded %s pickled records' % migrateRecords(conf)
+        return
+    distributed, address, authkey, timeout, n_shards, local = \
+        distributedSettings(conf)
+    if (distributed or options.worker) and authkey in ('', 'change-me'):
+        # the coordinator unpickles what workers send it (and vice versa), 
+        # so the key is all that stands between the port and running code 
+        print 'Set [Distributed] AUTHKEY to a secret of your own before a '\
+        'distributed run.'
+        sys.exit(2)
+    if options.worker:
+        print 'Working for the coordinator on %s:%s' % address
+        distributedWorker(conf, address, authkey)
+        return
     qualTrim = conf.getboolean('Steps', 'TRIM')
     qual = conf.getint('Qual', 'MIN_SCORE')
     linkerTrim = conf.getboolean('Steps', 'LINKERTRIM')
+    index = None
     if qualTrim and not linkerTrim:
-        createQualSeqTable(cur)
-        conn.commit()
+        sql = QUAL_INSERT
     elif qualTrim and linkerTrim:
-        mid, reverse_mid = dict(conf.items('MID')), reverse(conf.items('MID'))
-        linkers, reverse_linkers = dict(conf.items('Linker')), reverse(conf.items('Linker'))
-        #TODO:  Add levenshtein distance script to automagically determine 
-        #distance
-        reverse_mid[None] = None
-        reverse_linkers[None] = None
-        clust = conf.items('Clusters')
         # build tag library 1X
-        tags = tagLibrary(mid, linkers, clust)
-        all_tags, all_tags_regex = allPossibleTags(mid, linkers, clust)
-        # crank out a new table for the data
-        createSeqTable(cur)
-        conn.commit()
-    seqcount = sequenceCount(conf.get('Input','sequence'))
-    record = QualityIO.PairedFastaQualIterator(
-    open(conf.get('Input','sequence'), "rU"), 
-    open(conf.get('Input','qual'), "rU"))
+        index = tagIndex(conf)
+        index.report()
+        sql = LINKER_INSERT
+    # crank out a new table (or directory) for the data, unless we are 
+    # adding to an existing run
+    keep = options.resume or options.append
+    sequence, qual_file = inputSettings(conf)
+    if distributed and (qual_file is None or [f for f in (sequence, 
+    qual_file) if os.path.splitext(f)[1] in COMPRESSED]):
+        print 'Distributed runs need an uncompressed FASTA + QUAL pair.'
+        sys.exit(2)
+    prepareOutput(conf, sql, keep)
+    input = os.path.abspath(sequence)
+    stored, skip = 0, None
+    if keep:
+        stored, complete = checkpoints(conf).get(input, (0, False))
+        if complete:
+            print '%s has already been processed (%s reads stored)' % (input, 
+                stored)
+            return
+        if options.append and stored:
+            print '%s was only partly processed (%s reads stored) - use '\
+            '--resume' % (input, stored)
+            return
+        if options.resume:
+            skip = storedNames(conf)
+            # the output may be ahead of the checkpoint, and we skip by name -
+            # so count from what is really there
+            checkpointed = stored
+            stored = storedCount(sequence, skip, qual_file is None)
+            print 'Resuming %s:  %s reads stored at the last checkpoint, '\
+            '%s in the output' % (input, checkpointed, stored)
+    json_path, profile_rate, profile_path = reportSettings(conf)
+    STATS.profileRate(profile_rate)
+    seqcount = sequenceCount(sequence, fastq=qual_file is None)
+    record = inputRecords(conf)
+    if skip:
+        record = skipStored(record, skip)
     #pdb.set_trace()
-    if conf.getboolean('Multiprocessing', 'MULTIPROCESSING'):
+    concat_check = concatSetting(conf)
+    screen = readFilter(conf)
+    # reads are quality trimmed (and handed to workers) in chunks
+    if conf.has_option('Multiprocessing', 'CHUNKSIZE'):
+        chunksize = conf.getint('Multiprocessing', 'CHUNKSIZE')
+    else:
+        chunksize = 1000
+    if distributed:
+        # workers parse and search the shards, we write their rows
+        writer = openWriter(conf, sql, keep)
+        writer.track(input, stored)
+        pb = progress.bar(0,seqcount,60)
+        pb_inc = stored
+        for rows in coordinate(conf, sequence, qual_file, address, authkey, 
+        timeout, n_shards, local, skip):
+            for row in rows:
+                writer.write(row)
+            pb_inc += len(rows)
+            pb.__call__(pb_inc)
+        stats = writer.close()
+    elif conf.getboolean('Multiprocessing', 'MULTIPROCESSING'):
         # get num processors
         n_procs = conf.get('Multiprocessing','processors')
         if n_procs == 'Auto':
@@ -515,59 +3181,63 @@ def main():
         else:
             n_procs = int(n_procs)
         print 'Multiprocessing.  Number of processors = ', n_procs
-        # to test with fewer sequences
-        #count = 0
+        # compute in the pool, write from a single dedicated process
+        row_queue = multiprocessing.Queue(4)
+        stats_queue = multiprocessing.Queue()
+        writer = multiprocessing.Process(target=writerWorker, args=(conf, sql,
+            row_queue, stats_queue, keep, (input, stored)))
+        writer.start()
+        pb = progress.bar(0,seqcount,60)
+        pb_inc = stored
+        # the workers inherit the tag index, so all we ship them is chunks 
+        # of records - or, when sharding, just byte ranges of the input
+        n_procs = max(n_procs, 1)
+        sharding, n_shards = shardSettings(conf, n_procs)
+        if sharding and (qual_file is None or [f for f in (sequence, 
+        qual_file) if os.path.splitext(f)[1] in COMPRESSED]):
+            print 'Sharding needs an uncompressed FASTA + QUAL pair - not '\
+            'sharding'
+            sharding = False
+        if sharding:
+            results = shardPool(sequence, qual_file, conf, n_procs, n_shards, 
+                chunksize, index, skip)
+        else:
+            results = pool(record, conf, n_procs, chunksize, index)
         try:
-            threads = []
-            pb = progress.bar(0,seqcount,60)
-            pb_inc = 0
-            while record:
-                if len(threads) < n_procs:
-                    if qualTrim and not linkerTrim:
-                        p = multiprocessing.Process(target=qualOnlyWorker, args=(
-                        record.next(), qual, conf))
-                    elif qualTrim and linkerTrim:
-                        p = multiprocessing.Process(target=linkerWorker, args=(
-                        record.next(), qual, tags, all_tags, all_tags_regex, 
-                        reverse_mid, reverse_linkers, conf))
-                    p.start()
-                    threads.append(p)
-                    if (pb_inc+1)%1000 == 0:
-                        pb.__call__(pb_inc+1)
-                    elif pb_inc + 1 == seqcount:
-                        pb.__call__(pb_inc+1)
-                    pb_inc += 1
-                else:
-                    for t in threads:
-                        if not t.is_alive():
-                            threads.remove(t)
-        except StopIteration:
-            pass
+            for rows in results:
+                writerPut(writer, row_queue, stats_queue, rows)
+                pb_inc += len(rows)
+                pb.__call__(pb_inc)
+            writerPut(writer, row_queue, stats_queue, None)
+            stats = checkWriter(writer, stats_queue, True)
+        except:
+            # the writer would wait on us forever (and closing it would mark
+            # the input complete) - anything it committed is checkpointed.  
+            # Take back the rows it never read, or we'd hang at exit flushing
+            # them to the queue
+            writer.terminate()
+            drainQueue(row_queue)
+            raise
+        writer.join()
     else:
         print 'Not using multiprocessing'
-        count = 0
-        try:
-            pb = progress.bar(0,seqcount,60)
-            pb_inc = 0
-            #while count < 1000:
-            while record:
-                #count +=1
-                if qualTrim and not linkerTrim:
-                    qualOnlyWorker(record.next(), qual, conf)
-                elif qualTrim and linkerTrim:
-                    linkerWorker(record.next(), qual, tags, all_tags, 
-                    all_tags_regex, reverse_mid, reverse_linkers, conf)
-                if (pb_inc+1)%1000 == 0:
-                    pb.__call__(pb_inc+1)
-                elif pb_inc + 1 == seqcount:
-                    pb.__call__(pb_inc+1)
-                pb_inc += 1
-        except StopIteration:
-            pass
+        writer = openWriter(conf, sql, keep)
+        writer.track(input, stored)
+        pb = progress.bar(0,seqcount,60)
+        pb_inc = stored
+        for chunk in chunks(record, chunksize):
+            for row in processChunk(chunk, qual, index, concat_check, 
+            screen):
+                writer.write(row)
+            pb_inc += len(chunk)
+            pb.__call__(pb_inc)
+        stats = writer.close()
     print '\n'
-    cur.close()
-    conn.close()
+    index_time = finishOutput(conf, sql)
+    if index_time is not None:
+        STATS.time('index build', index_time)
     end_time = time.time()
+    STATS.report(stats, end_time - start_time, json_path, profile_path)
     print 'Ended: ', time.strftime("%a %b %d, %Y  %H:%M:%S", time.localtime(end_time))
     print '\nTime for execution: ', (end_time - start_time)/60, 'minutes'
 
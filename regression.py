@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+regression.py
+
+Deterministic regression checks for linkers.py, on reads simulated (with a
+fixed seed) from the MID, Linker and Clusters sections of a linkers.py
+configuration file:
+
+    - fuzzyMatch agrees with smithWaterman (pairwise2), apart from the known
+      kinds of difference (see classifyFuzzy), on a quarter of the reads -
+      pairwise2 is slow
+    - encodeRecord/decodeRecord round-trip Reads and SeqRecords
+    - the batch (Hamming) and per-read matching paths give the same rows, 
+      including on reads with ambiguity codes (or junk) between the tags
+    - 1 and N worker processes give the same rows, on input biased toward 
+      one of two linkers that some reads match equally well
+
+Prints one line per check and exits 1 if any of them fail.
+
+Copyright (c) 2010 Brant Faircloth. All rights reserved.
+"""
+
+import os, sys, random, array, optparse, ConfigParser
+import linkers, simulate, benchmark
+
+def classifyFuzzy(tag, sw, fuzzy):
+    '''Name the kind of difference between smithWaterman and fuzzyMatch
+    results (as benchmark.matchKey) - or None if it isn't one we know of:
+
+        gapped      pairwise2 picked a co-optimal alignment with long gaps
+                    for the tag in the read, which matches() then rejected
+                    (so it found nothing, or a chance match to another tag)
+        shifted     the same match, with start/end off by one (pairwise2
+                    alignments that begin with a padded gap)
+        elsewhere   the same tag, matched at another (equally good) place
+    '''
+    if fuzzy and fuzzy[0] == tag and (sw is None or sw[0] != tag):
+        return 'gapped'
+    if not (sw and fuzzy) or sw[0] != fuzzy[0]:
+        return None
+    (sw_start, sw_end), (start, end) = sw[1], fuzzy[1]
+    if sw[2] == fuzzy[2] and abs(sw_start - start) <= 1 and \
+    abs(sw_end - end) <= 1:
+        return 'shifted'
+    if abs(len(sw[2]) - len(fuzzy[2])) <= 2:
+        return 'elsewhere'
+    return None
+
+def checkFuzzy(tags, n):
+    '''Compare fuzzyMatch against smithWaterman on n reads'''
+    kinds, unknown = {}, []
+    for tag, seq in benchmark.tagReads(tags, n):
+        sw = benchmark.matchKey(linkers.smithWaterman(seq, tags, 1))
+        fuzzy = benchmark.matchKey(linkers.fuzzyMatch(seq, tags, 1))
+        if sw == fuzzy:
+            kind = 'identical'
+        else:
+            kind = classifyFuzzy(tag, sw, fuzzy)
+        if kind is None:
+            unknown.append((seq, sw, fuzzy))
+        else:
+            kinds[kind] = kinds.get(kind, 0) + 1
+    report('fuzzyMatch vs. smithWaterman (%s)' % ', '.join(['%s %s' % item
+        for item in sorted(kinds.items())]), unknown)
+    return not unknown
+
+def simulatedReads(index, n, min_score=10):
+    '''n simulated Reads for the clusters in index (a TagIndex)'''
+    simulator = simulate.ReadSimulator(index, min_score)
+    return [linkers.Read(t['name'], seq, array.array('B', scores)) for seq,
+        scores, t in simulator.reads(n)]
+
+def checkEncoding(records):
+    '''Round-trip records - untrimmed, trimmed, with N and ambiguity codes
+    (4-bit) or anything else (8-bit), and as SeqRecords - through
+    encodeRecord and decodeRecord'''
+    failed = []
+    for record in records:
+        seq = record.seq
+        variants = [record, record[3:-3], linkers.Read(record.id,
+            seq[:10] + 'N' + seq[11:], record.qual, 'length=%s' % len(seq)),
+            linkers.Read(record.id, seq[:10] + 'R' + seq[11:], record.qual),
+            linkers.Read(record.id, seq[:10] + '*' + seq[11:], record.qual)]
+        for read in variants:
+            decoded = linkers.decodeRecord(linkers.encodeRecord(read))
+            if (decoded.id, decoded.description, decoded.seq, decoded.qual,
+            decoded._seq, decoded.start, decoded.stop) != (read.id,
+            read.description, read.seq, read.qual, read._seq, read.start,
+            read.stop):
+                failed.append((read, decoded))
+        decoded = linkers.decodeRecord(linkers.encodeRecord(
+            record.toSeqRecord()))
+        if (decoded.id, decoded.seq, decoded.qual) != (record.id, record.seq,
+        record.qual):
+            failed.append((record, decoded))
+    report('encodeRecord/decodeRecord round trip (%s reads)' % len(records),
+        failed)
+    return not failed
+
+def rows(records, conf, index, chunksize=100):
+    '''The sequence table rows for records, processed in-process'''
+    qual = conf.getint('Qual', 'MIN_SCORE')
+    concat_check = linkers.concatSetting(conf)
+    screen = linkers.readFilter(conf)
+    return [row for chunk in linkers.chunks(iter(records), chunksize) for row
+        in linkers.processChunk(chunk, qual, index, concat_check, screen)]
+
+def gappedReads(conf, gaps=('RY', 'C*', 'N', 'a')):
+    '''Reads for each MID and the first linker with each of gaps between the
+    MID and the linker and after the reverse-complemented linker - the end 
+    regexes only allow [acgtnACGTN] there'''
+    linker = sorted(conf.items('Linker'))[0][1]
+    records = []
+    for mid_name, mid in sorted(conf.items('MID')):
+        for gap in gaps:
+            seq = mid + gap + linker + benchmark.randomSeq(150) + \
+                linkers.revComp(linker) + gap
+            records.append(linkers.Read('gapped-%s-%s' % (mid_name, gap), 
+                seq, array.array('B', [30] * len(seq))))
+    return records
+
+def checkBatch(conf, records):
+    '''Rows from the batch (Hamming) matcher vs. the per-read path'''
+    records = records + gappedReads(conf)
+    conf.set('Steps', 'HAMMING', 'True')
+    batch = rows(records, conf, linkers.tagIndex(conf))
+    conf.set('Steps', 'HAMMING', 'False')
+    per_read = rows(records, conf, linkers.tagIndex(conf))
+    differ = [(a, b) for a, b in zip(batch, per_read) if a != b]
+    report('batch vs. per-read rows (%s reads)' % len(records), differ)
+    return not differ
+
+def biasedReads(conf, n):
+    '''Add a twin of the first linker (2 substitutions away) to conf and 
+    return n reads for the first MID:  mostly the first linker for the first
+    half and its twin for the second, with every tenth read carrying a tag 
+    1 substitution from both (so only the tie-break decides it)'''
+    mid_name, mid = sorted(conf.items('MID'))[0]
+    linker_name, linker = sorted(conf.items('Linker'))[0]
+    i = len(linker) // 2
+    flip = lambda base: base == 'A' and 'T' or 'A'
+    twin = linker[:i] + flip(linker[i]) + flip(linker[i + 1]) + linker[i + 2:]
+    tie = linker[:i] + linker[i] + flip(linker[i + 1]) + linker[i + 2:]
+    conf.set('Linker', 'twin', twin)
+    conf.set('Clusters', '%s, twin' % mid_name, 'twin')
+    if not conf.has_option('Clusters', '%s, %s' % (mid_name, linker_name)):
+        conf.set('Clusters', '%s, %s' % (mid_name, linker_name), linker_name)
+    records = []
+    for j in xrange(n):
+        if j % 10 == 0:
+            tag = tie
+        elif j < n // 2:
+            tag = linker
+        else:
+            tag = twin
+        seq = mid + tag + benchmark.randomSeq(random.randint(100, 200)) + \
+            linkers.revComp(tag)
+        records.append(linkers.Read('biased%s' % j, seq, array.array('B', 
+            [30] * len(seq))))
+    return records
+
+def checkWorkers(conf, n, n_procs=3, chunksize=100):
+    '''Rows in-process and from pools of 1 and n_procs workers, on 
+    biasedReads'''
+    records = biasedReads(conf, n)
+    index = linkers.tagIndex(conf)
+    results = [('in-process', rows(records, conf, index, chunksize))]
+    for procs in (1, n_procs):
+        index = linkers.tagIndex(conf)
+        results.append(('%s workers' % procs, [row for chunk in linkers.pool(
+            iter(records), conf, procs, chunksize, index) for row in chunk]))
+    differ = []
+    for name, result in results[1:]:
+        differ.extend([(name, a, b) for a, b in zip(results[0][1], result) 
+            if a != b])
+    report('rows for 1 and %s workers (%s biased reads)' % (n_procs, n), 
+        differ)
+    return not differ
+
+def report(check, failed):
+    '''Print the outcome of one check, with the first few failures'''
+    if not failed:
+        print 'ok      %s' % check
+        return
+    print 'FAILED  %s:  %s failures' % (check, len(failed))
+    for failure in failed[:5]:
+        for item in failure:
+            print '        %r' % (item,)
+        print
+
+def interface():
+    '''Command-line interface'''
+    usage = "usage: %prog [options]"
+
+    p = optparse.OptionParser(usage)
+
+    p.add_option('--configuration', '-c', dest = 'conf', action='store', \
+type='string', default = None, help='The path to the configuration file.', \
+metavar='FILE')
+    p.add_option('--reads', '-n', dest = 'reads', action='store', \
+type='int', default = 2000, help='The number of reads to simulate.')
+    p.add_option('--seed', dest = 'seed', action='store', type='int', \
+default = 0, help='Random seed.')
+
+    (options,arg) = p.parse_args()
+    if not options.conf or not os.path.isfile(options.conf):
+        print "You must provide a valid path to the configuration file."
+        p.print_help()
+        sys.exit(2)
+    return options, arg
+
+def main():
+    options, arg = interface()
+    conf = ConfigParser.ConfigParser()
+    conf.read(options.conf)
+    index = linkers.tagIndex(conf)
+    random.seed(options.seed)
+    ok = checkFuzzy(index.tags.keys() + list(set(index.all_tags)),
+        max(options.reads // 4, 1))
+    random.seed(options.seed)
+    records = simulatedReads(index, options.reads, conf.getint('Qual',
+        'MIN_SCORE'))
+    ok = checkEncoding(records) and ok
+    ok = checkBatch(conf, records) and ok
+    ok = checkWorkers(conf, options.reads) and ok
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
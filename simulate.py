@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+simulate.py
+
+Generate synthetic 454 reads (FASTA + QUAL) with known MID, linker and cluster
+assignments from the MID, Linker and Clusters sections of a linkers.py
+configuration file.  Substitutions, indels, low quality ends and concatemers
+are added at controlled rates, and the truth for every read is written to a
+tab-delimited prefix.truth file alongside prefix.fna and prefix.qual.
+
+Copyright (c) 2010 Brant Faircloth. All rights reserved.
+"""
+
+import os, sys, random, optparse, ConfigParser
+import linkers
+
+# columns of the .truth file
+TRUTH_FIELDS = ('name', 'mid', 'linker', 'cluster', 'mid_errors',
+    'linker_errors', 'concat', 'trim_left', 'trim_right')
+
+def mutateRate(seq, sub_rate=0., indel_rate=0.):
+    '''Apply per-base substitutions (at sub_rate) and single-base insertions
+    or deletions (at indel_rate) to seq.  Returns (seq, number of errors)'''
+    out, errors = [], 0
+    for base in seq:
+        r = random.random()
+        if r < sub_rate:
+            out.append(random.choice('ACGT'.replace(base, '')))
+            errors += 1
+        elif r < sub_rate + indel_rate / 2.:
+            # deletion
+            errors += 1
+        elif r < sub_rate + indel_rate:
+            # insertion (454 errors are mostly homopolymer length errors, so
+            # repeat the base)
+            out.extend([base, base])
+            errors += 1
+        else:
+            out.append(base)
+    return ''.join(out), errors
+
+class ReadSimulator(object):
+    '''Build reads of [low quality bases] + MID + linker + insert + reverse
+    complement linker + [low quality bases] for the clusters in index (a
+    TagIndex).  Rates are per read except sub_rate and indel_rate, which are
+    per base:
+
+        sub_rate, indel_rate    sequencing errors (across the whole read)
+        low_qual_rate           rate of low quality bases at each end
+        concat_rate             rate of (1-error) linkers inside the insert
+        truncate_rate           rate of reads that end before the 3' linker
+        foreign_rate            rate of reads with an unknown MID or no tags
+    '''
+    def __init__(self, index, min_score=10, min_len=100, max_len=300,
+    sub_rate=0.002, indel_rate=0.004, low_qual_rate=0.2, concat_rate=0.05,
+    truncate_rate=0.1, foreign_rate=0.05):
+        self.index = index
+        self.min_score = min_score
+        self.min_len, self.max_len = min_len, max_len
+        self.sub_rate, self.indel_rate = sub_rate, indel_rate
+        self.low_qual_rate = low_qual_rate
+        self.concat_rate = concat_rate
+        self.truncate_rate = truncate_rate
+        self.foreign_rate = foreign_rate
+        self.pairs = [(mid, linker) for mid in index.tags for linker in
+            index.tags[mid]]
+        # MIDs in the configuration that no cluster uses
+        self.foreign = [mid for mid in index.reverse_mid if mid and mid not in
+            index.tags]
+    
+    def randomSeq(self, length):
+        return ''.join([random.choice('ACGT') for i in xrange(length)])
+    
+    def lowQuality(self):
+        '''A run of 1-5 bad bases (at the low_qual_rate)'''
+        if random.random() < self.low_qual_rate:
+            return random.randint(1, 5)
+        return 0
+    
+    def read(self, name):
+        '''Simulate one read, returning (sequence, quality scores, truth)'''
+        truth = dict(name=name, mid=None, linker=None, cluster=None,
+            mid_errors=0, linker_errors=0, concat=False)
+        foreign = random.random() < self.foreign_rate
+        insert = self.randomSeq(random.randint(self.min_len, self.max_len))
+        if not foreign and random.random() < self.concat_rate:
+            pos = random.randint(0, len(insert))
+            tag = random.choice(self.index.all_tags)
+            tag = mutateRate(tag, self.sub_rate, self.indel_rate)[0]
+            insert = insert[:pos] + tag + insert[pos:]
+            truth['concat'] = True
+        insert = mutateRate(insert, self.sub_rate, self.indel_rate)[0]
+        if foreign:
+            # unassignable - an unused MID, or no tags at all
+            if self.foreign and random.random() < 0.5:
+                seq = random.choice(self.foreign) + insert
+            else:
+                seq = insert
+        else:
+            mid, linker = random.choice(self.pairs)
+            m, mid_errors = mutateRate(mid, self.sub_rate, self.indel_rate)
+            l, linker_errors = mutateRate(linker, self.sub_rate,
+                self.indel_rate)
+            seq = m + l + insert
+            if random.random() >= self.truncate_rate:
+                r, errors = mutateRate(linkers.revComp(linker), self.sub_rate,
+                    self.indel_rate)
+                seq += r
+                linker_errors = max(linker_errors, errors)
+            truth.update(mid=self.index.reverse_mid[mid],
+                linker=self.index.reverse_linkers[linker],
+                cluster=self.index.tags[mid][linker], mid_errors=mid_errors,
+                linker_errors=linker_errors)
+        left, right = self.lowQuality(), self.lowQuality()
+        seq = self.randomSeq(left) + seq + self.randomSeq(right)
+        scores = [random.randint(self.min_score + 5, 40) for b in seq]
+        for i in xrange(left):
+            scores[i] = random.randint(0, self.min_score - 1)
+        for i in xrange(len(seq) - right, len(seq)):
+            scores[i] = random.randint(0, self.min_score - 1)
+        truth.update(trim_left=left, trim_right=right)
+        return seq, scores, truth
+    
+    def reads(self, n, prefix='sim'):
+        '''Simulate n reads, named prefix0 ... prefixN'''
+        for i in xrange(n):
+            yield self.read('%s%s' % (prefix, i))
+
+def writeReads(simulator, n, prefix):
+    '''Write n reads from simulator to prefix.fna, prefix.qual and
+    prefix.truth, returning the three paths'''
+    paths = [prefix + ext for ext in ('.fna', '.qual', '.truth')]
+    fasta, qual, truth = [open(p, 'w') for p in paths]
+    truth.write('#%s\n' % '\t'.join(TRUTH_FIELDS))
+    for seq, scores, t in simulator.reads(n, os.path.basename(prefix)):
+        fasta.write('>%s length=%s\n%s\n' % (t['name'], len(seq), seq))
+        qual.write('>%s length=%s\n%s\n' % (t['name'], len(seq),
+            ' '.join([str(q) for q in scores])))
+        truth.write('%s\n' % '\t'.join([str(t[f]) for f in TRUTH_FIELDS]))
+    for handle in (fasta, qual, truth):
+        handle.close()
+    return paths
+
+def readTruth(path):
+    '''Read a .truth file into a dictionary of read name -> truth'''
+    truth = {}
+    for line in open(path):
+        if line.startswith('#'):
+            continue
+        t = dict(zip(TRUTH_FIELDS, line.rstrip('\n').split('\t')))
+        for f in ('mid', 'linker', 'cluster'):
+            if t[f] == 'None':
+                t[f] = None
+        for f in ('mid_errors', 'linker_errors', 'trim_left', 'trim_right'):
+            t[f] = int(t[f])
+        t['concat'] = t['concat'] == 'True'
+        truth[t['name']] = t
+    return truth
+
+def interface():
+    '''Command-line interface'''
+    usage = "usage: %prog [options]"
+
+    p = optparse.OptionParser(usage)
+
+    p.add_option('--configuration', '-c', dest = 'conf', action='store', \
+type='string', default = None, help='The path to the configuration file.', \
+metavar='FILE')
+    p.add_option('--reads', '-n', dest = 'reads', action='store', \
+type='int', default = 10000, help='The number of reads to simulate.')
+    p.add_option('--output', '-o', dest = 'output', action='store', \
+type='string', default = 'sim', help='Output prefix (writes PREFIX.fna, \
+PREFIX.qual and PREFIX.truth).', metavar='PREFIX')
+    p.add_option('--seed', dest = 'seed', action='store', type='int', \
+default = None, help='Random seed.')
+    p.add_option('--sub-rate', dest = 'sub_rate', action='store', \
+type='float', default = 0.002, help='Per-base substitution rate.')
+    p.add_option('--indel-rate', dest = 'indel_rate', action='store', \
+type='float', default = 0.004, help='Per-base insertion/deletion rate.')
+    p.add_option('--low-qual-rate', dest = 'low_qual_rate', action='store', \
+type='float', default = 0.2, help='Rate of low quality bases at each end.')
+    p.add_option('--concat-rate', dest = 'concat_rate', action='store', \
+type='float', default = 0.05, help='Rate of concatemers.')
+    p.add_option('--truncate-rate', dest = 'truncate_rate', action='store', \
+type='float', default = 0.1, help="Rate of reads missing the 3' linker.")
+    p.add_option('--foreign-rate', dest = 'foreign_rate', action='store', \
+type='float', default = 0.05, help='Rate of reads with no known tags.')
+
+    (options,arg) = p.parse_args()
+    if not options.conf or not os.path.isfile(options.conf):
+        print "You must provide a valid path to the configuration file."
+        p.print_help()
+        sys.exit(2)
+    return options, arg
+
+def main():
+    options, arg = interface()
+    random.seed(options.seed)
+    conf = ConfigParser.ConfigParser()
+    conf.read(options.conf)
+    simulator = ReadSimulator(linkers.tagIndex(conf),
+        conf.getint('Qual', 'MIN_SCORE'), sub_rate=options.sub_rate,
+        indel_rate=options.indel_rate, low_qual_rate=options.low_qual_rate,
+        concat_rate=options.concat_rate,
+        truncate_rate=options.truncate_rate,
+        foreign_rate=options.foreign_rate)
+    for path in writeReads(simulator, options.reads, options.output):
+        print 'Wrote %s' % path
+
+if __name__ == '__main__':
+    main()